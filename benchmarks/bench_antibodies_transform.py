@@ -0,0 +1,139 @@
+"""
+Times Antibodies.transform_records_list against the previous groupby/iterrows
+implementation on a synthetic antibody table, and checks that both produce
+the same records.
+
+    python benchmarks/bench_antibodies_transform.py --rows 1000000
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+from target_api_plugins.entity_builders import Antibodies
+
+KEYS = [
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.OBSERVATION.NAME,
+    CONCEPT.OBSERVATION.ONTOLOGY_CODE,
+    CONCEPT.OBSERVATION.EVENT_AGE.VALUE,
+    CONCEPT.OBSERVATION.EVENT_AGE.UNITS,
+    CONCEPT.OBSERVATION.INTERPRETATION,
+]
+
+
+def legacy_transform_records_list(records_list):
+    """The groupby/iterrows implementation this benchmark compares against."""
+    df = pd.DataFrame(records_list)
+    df = df[df[CONCEPT.OBSERVATION.NAME].isin(["GAD", "IA2A", "MIAA"])]
+    transformed_records = []
+    for names, group in df.groupby(by=KEYS):
+        record = dict(zip(KEYS, names))
+        component_list = []
+        for _, row in group.iterrows():
+            name, value, units = row.get(
+                [
+                    "OBSERVATION|COMPONENT|NAME",
+                    "OBSERVATION|QUANTITY|VALUE",
+                    "OBSERVATION|QUANTITY|UNITS",
+                ]
+            )
+            component_list.append(
+                {
+                    "OBSERVATION|COMPONENT|NAME": name,
+                    "OBSERVATION|QUANTITY|VALUE": value,
+                    "OBSERVATION|QUANTITY|UNITS": units,
+                }
+            )
+        record["OBSERVATION|COMPONENT"] = component_list
+        transformed_records.append(record)
+
+    return transformed_records
+
+
+def antibody_records(rows, seed=0):
+    """A TEDDY-like antibody table: visits of participants, each with GAD,
+    IA2A and MIAA results (and some other tests that get filtered out), and
+    a few components per result.
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array(["GAD", "IA2A", "MIAA", "ZnT8A"])
+    codes = np.array(["56540-8", "31209-9", "8086-8", "76651-3"])
+    test = rng.integers(0, len(names), rows)
+    visit = rng.integers(0, max(rows // 12, 1), rows)
+    df = pd.DataFrame(
+        {
+            CONCEPT.PROJECT.ID: "SD_TEDDY",
+            CONCEPT.PARTICIPANT.ID: np.char.add("PT_", (visit // 20).astype(str)),
+            CONCEPT.OBSERVATION.NAME: names[test],
+            CONCEPT.OBSERVATION.ONTOLOGY_CODE: codes[test],
+            CONCEPT.OBSERVATION.EVENT_AGE.VALUE: (3 * (visit % 20)).astype(str),
+            CONCEPT.OBSERVATION.EVENT_AGE.UNITS: "Months",
+            CONCEPT.OBSERVATION.INTERPRETATION: np.where(
+                rng.random(rows) < 0.1, "Positive", "Negative"
+            ),
+            "OBSERVATION|COMPONENT|NAME": np.array(["Index", "Titer", "Units"])[
+                rng.integers(0, 3, rows)
+            ],
+            "OBSERVATION|QUANTITY|VALUE": np.round(rng.random(rows) * 100, 2).astype(
+                str
+            ),
+            "OBSERVATION|QUANTITY|UNITS": "DK units",
+        }
+    )
+    return df.to_dict("records")
+
+
+def same_records(a, b):
+    """Compares transformed records, with NaN equal to NaN."""
+
+    def normalize(value):
+        if isinstance(value, float) and math.isnan(value):
+            return "NaN"
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        return value
+
+    return normalize(a) == normalize(b)
+
+
+def timed(func, records_list):
+    start = time.perf_counter()
+    result = func(records_list)
+    return result, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument(
+        "--skip_legacy",
+        action="store_true",
+        help="Only time the current implementation",
+    )
+    args = parser.parse_args(argv)
+
+    records_list = antibody_records(args.rows)
+    result, elapsed = timed(Antibodies.transform_records_list, records_list)
+    print(
+        f"transform_records_list: {args.rows} rows -> {len(result)} records"
+        f" in {elapsed:.2f}s"
+    )
+    if args.skip_legacy:
+        return
+
+    legacy_result, legacy_elapsed = timed(legacy_transform_records_list, records_list)
+    print(f"groupby/iterrows: {legacy_elapsed:.2f}s")
+    print(f"speedup: {legacy_elapsed / elapsed:.1f}x")
+    if not same_records(result, legacy_result):
+        raise SystemExit("Results differ from the groupby/iterrows implementation")
+    print("results match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Submits FHIR resources with aiohttp on an asyncio event loop, keeping many
+requests in flight from a single thread.
+"""
+import asyncio
+import atexit
+import json
+import threading
+import time
+
+import aiohttp
+from requests import RequestException, Response
+from requests.structures import CaseInsensitiveDict
+
+from target_api_plugins.metrics import metrics
+from target_api_plugins.rate_control import (
+    RETRY_STATUSES,
+    THROTTLE_STATUSES,
+    parse_retry_after,
+)
+from target_api_plugins.utils import NO_RESOURCE_WITH_ID, response_resource_id
+
+# What a failed request raises besides RequestException
+ASYNC_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class AsyncSubmitter:
+    """Sends resources to the FHIR service with a bounded number of requests
+    in flight per entity class and per host.
+
+    Coroutines (submit, submit_all) can be awaited from async code. Sync code
+    such as the loader's submit() hook can call submit_threadsafe, which hands
+    the request to an event loop running in one background thread and waits
+    for its result. Requests from many threads calling submit_threadsafe at
+    once (e.g. the loader with --use_async) are in flight together.
+    """
+
+    def __init__(
+        self,
+        max_in_flight_per_class=100,
+        max_in_flight_per_host=200,
+        headers=None,
+        auth=None,
+        retries=3,
+        backoff_factor=0.5,
+        post_fallback=True,
+    ):
+        """
+        :param max_in_flight_per_class: Maximum concurrent requests for one
+            entity class
+        :type max_in_flight_per_class: int
+        :param max_in_flight_per_host: Maximum concurrent requests (and open
+            connections) to one host
+        :type max_in_flight_per_host: int
+        :param headers: Headers sent with every request
+        :type headers: dict
+        :param auth: (username, password) for basic auth
+        :type auth: tuple
+        :param retries: How many times to retry a PUT after a connection
+            error or a status in RETRY_STATUSES, or a POST that the server
+            turned away before processing it
+        :type retries: int
+        :param backoff_factor: Seconds to sleep before the first retry,
+            doubled for every retry after that
+        :type backoff_factor: float
+        :param post_fallback: Whether to POST a resource whose ID the server
+            doesn't know, letting the server assign a new ID
+        :type post_fallback: bool
+        """
+        self.max_in_flight_per_class = max_in_flight_per_class
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+        self.auth = aiohttp.BasicAuth(*auth) if auth else None
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.post_fallback = post_fallback
+        self._session = None
+        self._class_limits = {}
+        self._host_limits = {}
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0, limit_per_host=self.max_in_flight_per_host
+                ),
+                headers=self.headers,
+                auth=self.auth,
+            )
+        return self._session
+
+    @staticmethod
+    def _response(resp, text):
+        """Copies a read aiohttp response into a requests.Response, so that
+        callers see the same responses (and errors) as from synchronous
+        submits.
+        """
+        response = Response()
+        response.status_code = resp.status
+        response.reason = resp.reason
+        response.headers = CaseInsensitiveDict(resp.headers)
+        response.url = str(resp.url)
+        response.encoding = "utf-8"
+        response._content = text.encode("utf-8")
+        return response
+
+    def _limit(self, limits, key, size):
+        if key not in limits:
+            limits[key] = asyncio.Semaphore(size)
+        return limits[key]
+
+    async def _request(self, method, url, body):
+        session = self._get_session()
+        data = json.dumps(body).encode("utf-8")
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                async with session.request(method, url, data=data) as resp:
+                    text = await resp.text()
+                    metrics.record_request(
+                        method,
+                        url,
+                        time.monotonic() - start,
+                        status=resp.status,
+                        retries=int(attempt > 0),
+                        bytes_sent=len(data),
+                        bytes_received=len(text.encode("utf-8")),
+                    )
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                    if attempt == self.retries or not self._retryable(
+                        method, resp.status, retry_after
+                    ):
+                        return self._response(resp, text)
+            except aiohttp.ClientConnectionError as e:
+                metrics.record_request(
+                    method, url, time.monotonic() - start, retries=int(attempt > 0)
+                )
+                # A POST may have reached the server unless the connection
+                # was never made
+                if attempt == self.retries or (
+                    method == "POST" and not isinstance(e, aiohttp.ClientConnectorError)
+                ):
+                    raise
+                retry_after = None
+            delay = self.backoff_factor * (2**attempt)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retryable(method, status, retry_after):
+        if method != "POST":
+            return status in RETRY_STATUSES
+        return status in THROTTLE_STATUSES and retry_after is not None
+
+    async def submit(self, entity_class, host, body):
+        """Negotiates submitting the data for an entity to the target service.
+
+        :param entity_class: Which entity class is being sent
+        :type entity_class: class
+        :param host: A host url
+        :type host: str
+        :param body: Map between entity keys and values
+        :type body: dict
+        :raise: RequestException or one of ASYNC_ERRORS on error
+        :return: The target entity ID that the service says was created or
+            updated
+        :rtype: str
+        """
+        api_path = entity_class.api_path
+        base = "/".join([v.strip("/") for v in [host, api_path]])
+        class_limit = self._limit(
+            self._class_limits, entity_class.class_name, self.max_in_flight_per_class
+        )
+        host_limit = self._limit(self._host_limits, host, self.max_in_flight_per_host)
+
+        async with class_limit, host_limit:
+            resp = None
+            resource_id = body.get("id")
+            if resource_id:
+                resp = await self._request(
+                    "PUT", f"{base}/{resource_id.strip('/')}", body
+                )
+                if (
+                    self.post_fallback
+                    and resp.status_code not in {200, 201}
+                    and NO_RESOURCE_WITH_ID in resp.text
+                ):
+                    resp = None
+            else:
+                body = {k: v for k, v in body.items() if k != "id"}
+
+            if not resp:
+                resp = await self._request("POST", base, body)
+
+        if resp.status_code in {200, 201}:
+            return response_resource_id(resp)
+        else:
+            raise RequestException(
+                f"Sent to /{api_path}:\n{body}\nGot:\n{resp.text}", response=resp
+            )
+
+    async def submit_all(self, entity_class, host, bodies):
+        """Submits many resources concurrently.
+
+        :param entity_class: Which entity class is being sent
+        :type entity_class: class
+        :param host: A host url
+        :type host: str
+        :param bodies: FHIR resources
+        :type bodies: iterable of dicts
+        :return: For each body in order, its target entity ID or the
+            exception raised while submitting it
+        :rtype: list
+        """
+        return await asyncio.gather(
+            *(self.submit(entity_class, host, body) for body in bodies),
+            return_exceptions=True,
+        )
+
+    def _get_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever,
+                    name="fhir-async-submit",
+                    daemon=True,
+                ).start()
+                atexit.register(self.close)
+        return self._loop
+
+    def run(self, coro):
+        """Runs a coroutine on the background event loop and waits for it."""
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    def submit_threadsafe(self, entity_class, host, body):
+        """Blocking wrapper around submit for callers outside the event loop."""
+        return self.run(self.submit(entity_class, host, body))
+
+    def close(self):
+        """Closes the HTTP session and stops the background event loop."""
+        if self._loop is None or self._loop.is_closed():
+            return
+        if self._session is not None:
+            self.run(self._session.close())
+            self._session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
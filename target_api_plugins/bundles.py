@@ -0,0 +1,310 @@
+"""
+Submits FHIR resources in batch or transaction Bundles
+(https://www.hl7.org/fhir/http.html#transaction) instead of one request per
+resource.
+"""
+import threading
+from concurrent.futures import Future
+
+from requests import RequestException
+
+from target_api_plugins.utils import (
+    NO_RESOURCE_WITH_ID,
+    resource_id_from_location,
+    send_request,
+)
+
+BUNDLE_TYPES = {"batch", "transaction"}
+
+
+class BundleErrors(RequestException):
+    """Raised for the resources that the server rejected after submit had
+    already returned their IDs.
+
+    :ivar errors: The exception raised for each of them
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            f"{len(errors)} Bundled resource(s) were rejected:\n"
+            + "\n".join(str(e) for e in errors)
+        )
+
+
+class BundleSubmitter:
+    """Collects resources handed to submit() into per-entity-class Bundles.
+
+    With client_ids, the server keeps the ID a resource is PUT with, so submit
+    returns that ID right away and the resource waits in its Bundle until the
+    Bundle is full, a resource of another entity class is submitted (the
+    loader is done with this class), or flush() is called. Failures are then
+    handed to on_error, and the ones it doesn't handle are raised together
+    from the next submit or flush.
+
+    Otherwise the caller needs the server's answer to learn its resource's ID,
+    so submit blocks. Its Bundle is sent at once unless a Bundle for the same
+    entity class is already in flight, in which case the resources submitted
+    meanwhile go out together once that one is answered. A single-threaded
+    loader thus sends one-entry Bundles without waiting, and concurrent
+    submits (e.g. with --use_async) fill up Bundles.
+
+    In a batch Bundle each entry succeeds or fails on its own, and a failed
+    entry only raises for the resource it holds. A PUT entry that fails
+    because no resource has its ID is sent again as a POST, as the REST
+    submitter does. In a transaction Bundle the server applies all entries or
+    none.
+    """
+
+    def __init__(
+        self,
+        host,
+        bundle_type="batch",
+        bundle_size=100,
+        client_ids=False,
+        on_success=None,
+        on_error=None,
+        **kwargs,
+    ):
+        """
+        :param host: A FHIR service base URL
+        :type host: str
+        :param bundle_type: "batch" or "transaction"
+        :type bundle_type: str
+        :param bundle_size: Maximum number of entries per Bundle
+        :type bundle_size: int
+        :param client_ids: Whether the server creates resources PUT with an
+            ID it doesn't have yet, so that resources with an ID need not
+            wait for their Bundle
+        :type client_ids: bool
+        :param on_success: Called with (entity_class, body, resource_id) for
+            every resource once the server has accepted it
+        :type on_success: function
+        :param on_error: Called with (entity_class, body, exception) for every
+            resource with an ID that the server rejects. Returns whether it
+            handled the failure, which is raised later otherwise.
+        :type on_error: function
+        :param kwargs: Extra keyword arguments (e.g. headers, auth) passed to
+            every POST
+        """
+        if bundle_type not in BUNDLE_TYPES:
+            raise ValueError(
+                f"Bundle type must be one of {sorted(BUNDLE_TYPES)}, "
+                f"not {bundle_type!r}"
+            )
+        self.host = host.rstrip("/")
+        self.bundle_type = bundle_type
+        self.bundle_size = max(int(bundle_size), 1)
+        self.client_ids = client_ids
+        self.on_success = on_success
+        self.on_error = on_error
+        self.kwargs = kwargs
+        self._pending = {}
+        self._in_flight = {}
+        self._errors = []
+        self._last_key = None
+        self._lock = threading.Lock()
+
+    def submit(self, entity_class, body):
+        """Adds a resource to the next Bundle for its entity class.
+
+        :param entity_class: Which entity class is being sent
+        :type entity_class: class
+        :param body: FHIR resource
+        :type body: dict
+        :raise: RequestException if the server rejected this entry, or
+            BundleErrors if it rejected earlier ones that didn't wait for
+            their Bundle
+        :return: The target entity ID that the service says was created or
+            updated
+        :rtype: str
+        """
+        self._raise_errors()
+        key = entity_class.class_name
+        wait = not (self.client_ids and body.get("id"))
+        future = Future()
+
+        finished = []
+        batch = None
+        with self._lock:
+            if key != self._last_key:
+                # The loader moved on to another entity class
+                finished = [
+                    (k, self._pending.pop(k)) for k in list(self._pending) if k != key
+                ]
+                self._last_key = key
+            pending = self._pending.setdefault(key, [])
+            pending.append((entity_class, body, future, wait))
+            if len(pending) >= self.bundle_size or (
+                wait and not self._in_flight.get(key)
+            ):
+                batch = self._take(key)
+        for k, stale in finished:
+            self._send_all(k, stale, in_flight=False)
+        if batch:
+            self._send_all(key, batch)
+
+        if wait:
+            return future.result()
+        return body["id"]
+
+    def flush(self):
+        """Sends every partially filled Bundle right away.
+
+        :raise: BundleErrors if the server rejected resources that didn't
+            wait for their Bundle, and on_error didn't handle them
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for key, batch in pending.items():
+            self._send_all(key, batch, in_flight=False)
+        self._raise_errors()
+
+    def _raise_errors(self):
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise BundleErrors(errors)
+
+    def _take(self, key):
+        """Pops the pending entries of an entity class and counts them as in
+        flight. Call while holding the lock.
+        """
+        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        return self._pending.pop(key)
+
+    def _send_all(self, key, batch, in_flight=True):
+        """Sends a batch, then whatever was submitted for the same entity class
+        while it was in flight and is waiting for an answer.
+        """
+        while batch:
+            try:
+                self._send(batch)
+            except Exception as e:
+                # Don't leave anyone waiting on an entry that got no answer
+                for entity_class, body, future, wait in batch:
+                    if not future.done():
+                        self._fail(entity_class, body, future, wait, e)
+            finally:
+                if in_flight:
+                    with self._lock:
+                        self._in_flight[key] -= 1
+            if not in_flight:
+                return
+            with self._lock:
+                pending = self._pending.get(key, [])
+                waiting = any(wait for _, _, _, wait in pending)
+                batch = self._take(key) if waiting else None
+
+    def _succeed(self, entity_class, body, future, resource_id):
+        if self.on_success is not None:
+            self.on_success(entity_class, body, resource_id)
+        future.set_result(resource_id)
+
+    def _fail(self, entity_class, body, future, wait, error):
+        future.set_exception(error)
+        if wait:
+            return
+        if self.on_error is None or not self.on_error(entity_class, body, error):
+            with self._lock:
+                self._errors.append(error)
+
+    def _send(self, batch):
+        bundle = {
+            "resourceType": "Bundle",
+            "type": self.bundle_type,
+            "entry": [
+                self._entry(entity_class, body) for entity_class, body, _, _ in batch
+            ],
+        }
+
+        try:
+            resp = send_request("POST", self.host, json=bundle, **self.kwargs)
+        except Exception as e:
+            for entity_class, body, future, wait in batch:
+                self._fail(entity_class, body, future, wait, e)
+            return
+
+        entries = self._response_entries(resp)
+        if entries is None:
+            for entity_class, body, future, wait in batch:
+                self._fail(
+                    entity_class,
+                    body,
+                    future,
+                    wait,
+                    RequestException(
+                        f"Sent to /{entity_class.api_path} in a {self.bundle_type} "
+                        f"Bundle:\n{body}\nGot:\n{resp.text}",
+                        response=resp,
+                    ),
+                )
+            return
+
+        retry = []
+        for i, (entity_class, body, future, wait) in enumerate(batch):
+            entry = entries[i] if i < len(entries) else {}
+            response = entry.get("response") or {}
+            status = str(response.get("status", ""))
+            resource_id = (entry.get("resource") or {}).get("id") or (
+                resource_id_from_location(response.get("location"))
+            )
+            if status.startswith("2") and resource_id:
+                self._succeed(entity_class, body, future, resource_id)
+            elif wait and body.get("id") and self._no_such_id(response):
+                retry.append(
+                    (
+                        entity_class,
+                        {k: v for k, v in body.items() if k != "id"},
+                        future,
+                        wait,
+                    )
+                )
+            else:
+                self._fail(
+                    entity_class,
+                    body,
+                    future,
+                    wait,
+                    RequestException(
+                        f"Sent to /{entity_class.api_path} in a {self.bundle_type} "
+                        f"Bundle:\n{body}\nGot:\n{response or 'no response entry'}",
+                        response=resp,
+                    ),
+                )
+        if retry:
+            # Create the resources whose IDs the server doesn't know
+            self._send(retry)
+
+    @staticmethod
+    def _response_entries(resp):
+        """The entries of a Bundle response, or None if the server didn't
+        answer with a Bundle (e.g. an error, or a proxy's HTML page).
+        """
+        if resp.status_code != 200:
+            return None
+        try:
+            entries = resp.json().get("entry", [])
+        except (ValueError, AttributeError):
+            return None
+        if not isinstance(entries, list) or not all(
+            isinstance(entry, dict) for entry in entries
+        ):
+            return None
+        return entries
+
+    @staticmethod
+    def _no_such_id(response):
+        issues = (response.get("outcome") or {}).get("issue") or [{}]
+        return NO_RESOURCE_WITH_ID in issues[0].get("diagnostics", "")
+
+    @staticmethod
+    def _entry(entity_class, body):
+        api_path = entity_class.api_path
+        resource_id = body.get("id")
+        if resource_id:
+            request = {"method": "PUT", "url": f"{api_path}/{resource_id}"}
+        else:
+            body = {k: v for k, v in body.items() if k != "id"}
+            request = {"method": "POST", "url": api_path}
+        return {"resource": body, "request": request}
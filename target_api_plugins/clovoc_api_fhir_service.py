@@ -1,10 +1,41 @@
+import atexit
+import json
+import logging
 import os
+import sys
+import threading
 
 from dotenv import find_dotenv, load_dotenv
 from requests import RequestException
 
 # from config import ROOT_DIR
 from kf_lib_data_ingest.app.settings.production import SECRETS, AUTH_CONFIGS
+from target_api_plugins.async_submit import ASYNC_ERRORS, AsyncSubmitter
+from target_api_plugins.bundles import BUNDLE_TYPES, BundleErrors, BundleSubmitter
+from target_api_plugins.content_hashes import ContentHashStore, submit_counts
+from target_api_plugins.dead_letter import (
+    DEAD_LETTERED,
+    DeadLetterQueue,
+    DependencyDeadLettered,
+)
+from target_api_plugins.metrics import FHIR_METRICS_DIR, metrics
+from target_api_plugins.ndjson_export import NdjsonExporter
+from target_api_plugins.id_resolution import (
+    FHIR_ID_STRATEGY,
+    forget_target_id,
+    remember_target_id,
+    skip_target_id_lookups,
+    skip_target_id_searches,
+)
+from target_api_plugins.utils import (
+    NO_RESOURCE_WITH_ID,
+    escape_filters,
+    not_none,
+    response_diagnostics,
+    response_resource_id,
+    response_version,
+    send_request,
+)
 from target_api_plugins.entity_builders import (
     Practitioner,
     Patient,
@@ -26,10 +57,10 @@ from target_api_plugins.entity_builders import (
 
 TARGET_API_CONFIG = os.path.abspath(__file__)
 
-from d3b_utils.requests_retry import Session
-
 LOADER_VERSION = 2
 
+logger = logging.getLogger(__name__)
+
 
 DOTENV_PATH = find_dotenv()
 if DOTENV_PATH:
@@ -39,9 +70,72 @@ FHIR_COOKIE = os.getenv("FHIR_COOKIE")
 FHIR_USERNAME = os.getenv("FHIR_USERNAME")
 FHIR_PASSWORD = os.getenv("FHIR_PASSWORD")
 
+# How resources are sent: "rest" (one request per resource), "batch" or
+# "transaction" (many resources per Bundle), "async" (aiohttp event loop), or
+# "conditional" (one create-or-update PUT per resource, matched by its key), or
+# "ndjson" (write gzipped NDJSON files to FHIR_EXPORT_DIR instead of sending)
+FHIR_SUBMIT_MODE = os.getenv("FHIR_SUBMIT_MODE", "rest").lower()
+FHIR_BUNDLE_SIZE = int(os.getenv("FHIR_BUNDLE_SIZE", 100))
+FHIR_ASYNC_MAX_IN_FLIGHT_PER_CLASS = int(
+    os.getenv("FHIR_ASYNC_MAX_IN_FLIGHT_PER_CLASS", 100)
+)
+FHIR_ASYNC_MAX_IN_FLIGHT_PER_HOST = int(
+    os.getenv("FHIR_ASYNC_MAX_IN_FLIGHT_PER_HOST", 200)
+)
+
+# Whether to ask the service to leave created and updated resources out of
+# its responses, reading their IDs from the Location header instead
+FHIR_RETURN_MINIMAL = os.getenv("FHIR_RETURN_MINIMAL", "false").lower() == "true"
+
+# Whether to update a Group that already exists by PATCHing in only its
+# member changes, FHIR_GROUP_PATCH_SIZE JSON Patch operations per request
+FHIR_GROUP_PATCH = os.getenv("FHIR_GROUP_PATCH", "false").lower() == "true"
+FHIR_GROUP_PATCH_SIZE = int(os.getenv("FHIR_GROUP_PATCH_SIZE", 500))
+
+# How many times a Group that others change while it is being patched is
+# read and diffed again
+GROUP_PATCH_ATTEMPTS = 3
+
+FHIR_EXPORT_DIR = os.getenv("FHIR_EXPORT_DIR")
+FHIR_EXPORT_COMPRESSLEVEL = int(os.getenv("FHIR_EXPORT_COMPRESSLEVEL", 6))
+
+SUBMIT_MODES = {"rest", "async", "conditional", "ndjson"} | BUNDLE_TYPES
+if FHIR_SUBMIT_MODE not in SUBMIT_MODES:
+    raise ValueError(
+        f"FHIR_SUBMIT_MODE must be one of {sorted(SUBMIT_MODES)}, "
+        f"not {FHIR_SUBMIT_MODE!r}"
+    )
+
+exporter = None
+if FHIR_SUBMIT_MODE == "ndjson":
+    if not FHIR_EXPORT_DIR:
+        raise ValueError("FHIR_SUBMIT_MODE=ndjson needs FHIR_EXPORT_DIR")
+    exporter = NdjsonExporter(FHIR_EXPORT_DIR, compresslevel=FHIR_EXPORT_COMPRESSLEVEL)
+    # Exported resources reference each other by deterministic or freshly
+    # minted IDs, never by IDs found on a server
+    skip_target_id_lookups()
+
+# SQLite file with the hash of the last body submitted for each resource,
+# used to skip resubmitting unchanged resources
+FHIR_CONTENT_HASHES = os.getenv("FHIR_CONTENT_HASHES")
+content_hashes = ContentHashStore(FHIR_CONTENT_HASHES) if FHIR_CONTENT_HASHES else None
+
+# JSON lines file that collects rejected resources, and the records that
+# reference them, instead of aborting
+FHIR_DEAD_LETTER_PATH = os.getenv("FHIR_DEAD_LETTER_PATH")
+dead_letters = DeadLetterQueue(FHIR_DEAD_LETTER_PATH) if FHIR_DEAD_LETTER_PATH else None
+
+metrics.sections["submit_counts"] = submit_counts.summary
+
+_bundle_submitters = {}
+_submitters_lock = threading.Lock()
+_async_submitter = None
+_unguarded_key_components = {}
+
 
 def _PUT(host, api_path, resource_id, body, headers, auth=None):
-    return Session().put(
+    return send_request(
+        "PUT",
         "/".join([v.strip("/") for v in [host, api_path, resource_id]]),
         json=body,
         headers=headers,
@@ -50,7 +144,8 @@ def _PUT(host, api_path, resource_id, body, headers, auth=None):
 
 
 def _POST(host, api_path, body, headers, auth=None):
-    return Session().post(
+    return send_request(
+        "POST",
         "/".join([v.strip("/") for v in [host, api_path]]),
         json=body,
         headers=headers,
@@ -58,19 +153,196 @@ def _POST(host, api_path, body, headers, auth=None):
     )
 
 
-def submit(entity_class, host, body):
-    """Negotiates submitting the data for an entity to the target service.
+def _conditional_PUT(host, api_path, params, body, headers, auth=None):
+    return send_request(
+        "PUT",
+        "/".join([v.strip("/") for v in [host, api_path]]),
+        params=params,
+        json=body,
+        headers=headers,
+        auth=auth,
+    )
+
+
+def conditional_params(entity_class, body):
+    """The search parameters of a conditional update: the entity's key
+    components, rebuilt from its FHIR resource by the builder's
+    get_key_components_from_body, with their values escaped.
 
     :param entity_class: Which entity class is being sent
     :type entity_class: class
-    :param host: A host url
-    :type host: str
-    :param body: Map between entity keys and values
+    :param body: FHIR resource
     :type body: dict
-    :raise: RequestException on error
-    :return: The target entity ID that the service says was created or updated
+    :return: search parameters matching the same resource as the builder's
+        get_key_components
+    :rtype: dict
+    """
+    return escape_filters(entity_class.get_key_components_from_body(body))
+
+
+def _submit_conditional(entity_class, host, body, headers, auth=None):
+    api_path = entity_class.api_path
+    body = {k: v for k, v in body.items() if k != "id"}
+    resp = _conditional_PUT(
+        host, api_path, conditional_params(entity_class, body), body, headers, auth
+    )
+
+    if resp.status_code in {200, 201}:
+        skip_target_id_searches(api_path)
+        return response_resource_id(resp)
+    else:
+        raise RequestException(
+            f"Sent to /{api_path}:\n{body}\nGot:\n{resp.text}", response=resp
+        )
+
+
+def _patch_group(host, body, headers, auth=None):
+    """Updates a Group that is already on the server by sending only its
+    member changes, as chunks of JSON Patch operations. Each chunk is sent
+    If-Match the version the previous one produced. If someone else changes
+    the Group in between, the server refuses the chunk (412) and the Group
+    is read and diffed again, so that their change isn't overwritten.
+
+    The Group is still read whole, and its builder still resolves every
+    member, so only the upload and the server's write shrink to the size of
+    the change.
+
+    :raise: RequestException if the Group kept changing for
+        GROUP_PATCH_ATTEMPTS reads
+    :return: the Group's ID, or None if it has to be sent whole instead,
+        because it isn't on the server yet, more than membership changed, or
+        the server refused a patch for another reason
     :rtype: str
     """
+    url = "/".join([v.strip("/") for v in [host, Group.api_path, body["id"]]])
+    for _ in range(GROUP_PATCH_ATTEMPTS):
+        resp = send_request("GET", url, headers=headers, auth=auth)
+        if resp.status_code != 200:
+            return None
+        operations = Group.membership_patch(resp.json(), body)
+        if operations is None:
+            return None
+
+        resp = _send_patches(url, operations, response_version(resp), headers, auth)
+        if resp is None:
+            return body["id"]
+        if resp.status_code != 412:
+            logger.warning(
+                f"PATCH of {url} failed with {resp.status_code}, "
+                "sending the whole Group instead"
+            )
+            return None
+        logger.info(f"{url} changed while being patched, diffing it again")
+
+    raise RequestException(
+        f"{url} kept changing while being patched:\n{resp.text}", response=resp
+    )
+
+
+def _send_patches(url, operations, version, headers, auth=None):
+    """Sends JSON Patch operations FHIR_GROUP_PATCH_SIZE at a time, each
+    chunk If-Match the version the previous one produced.
+
+    :return: the response to the first chunk that failed, or None
+    """
+    patch_headers = dict(headers, **{"Content-Type": "application/json-patch+json"})
+    for start in range(0, len(operations), FHIR_GROUP_PATCH_SIZE):
+        if version:
+            patch_headers["If-Match"] = f'W/"{version}"'
+        resp = send_request(
+            "PATCH",
+            url,
+            data=json.dumps(operations[start : start + FHIR_GROUP_PATCH_SIZE]),
+            headers=patch_headers,
+            auth=auth,
+        )
+        if not 200 <= resp.status_code < 300:
+            return resp
+        version = response_version(resp)
+    return None
+
+
+def _bundle_success(host):
+    """Records a Bundled resource once the server has accepted it, since
+    submit may have returned its ID before its Bundle was sent.
+    """
+
+    def on_success(entity_class, body, resource_id):
+        _record_sent(entity_class, host, body, resource_id)
+
+    return on_success
+
+
+def _bundle_error(host):
+    """Handles a resource that was rejected after submit already returned its
+    ID: it is dead-lettered if dead-lettering is on, and raised from the next
+    submit otherwise.
+    """
+
+    def on_error(entity_class, body, error):
+        metrics.record_submit(entity_class, ok=False)
+        if dead_letters is None:
+            return False
+        _dead_letter(entity_class, host, body, error)
+        return True
+
+    return on_error
+
+
+def _get_bundle_submitter(host, headers, auth=None):
+    with _submitters_lock:
+        if host not in _bundle_submitters:
+            _bundle_submitters[host] = BundleSubmitter(
+                host,
+                bundle_type=FHIR_SUBMIT_MODE,
+                bundle_size=FHIR_BUNDLE_SIZE,
+                client_ids=FHIR_ID_STRATEGY == "deterministic",
+                on_success=_bundle_success(host),
+                on_error=_bundle_error(host),
+                headers=headers,
+                auth=auth,
+            )
+        return _bundle_submitters[host]
+
+
+def flush_bundles():
+    """Sends the resources still waiting in partially filled Bundles.
+
+    :raise: BundleErrors if the server rejected any of them, unless
+        dead-lettering is on
+    """
+    with _submitters_lock:
+        submitters = list(_bundle_submitters.values())
+    for submitter in submitters:
+        submitter.flush()
+
+
+def _flush_bundles_at_exit():
+    try:
+        flush_bundles()
+    except BundleErrors as e:
+        logger.error(f"Failed to submit the last Bundled resources: {e}")
+        # An exit handler can't set the exit status, so end the process here,
+        # after the exit work of the handlers that would still run
+        submit_counts.log_summary()
+        if FHIR_METRICS_DIR:
+            metrics.write(FHIR_METRICS_DIR)
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+
+
+atexit.register(_flush_bundles_at_exit)
+
+
+def request_config():
+    """Headers and auth sent with every request to the FHIR service, from
+    FHIR_COOKIE, FHIR_USERNAME/FHIR_PASSWORD and FHIR_RETURN_MINIMAL.
+
+    :return: (headers, auth)
+    :rtype: tuple
+    """
     headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
     auth = None
 
@@ -80,27 +352,251 @@ def submit(entity_class, host, body):
     if FHIR_USERNAME and FHIR_PASSWORD:
         auth = (FHIR_USERNAME, FHIR_PASSWORD)
 
+    if FHIR_RETURN_MINIMAL:
+        headers["Prefer"] = "return=minimal"
+
+    return headers, auth
+
+
+def get_async_submitter():
+    """Returns the process-wide AsyncSubmitter, creating it on first use with
+    the headers and auth of request_config().
+    """
+    global _async_submitter
+    with _submitters_lock:
+        if _async_submitter is None:
+            headers, auth = request_config()
+            _async_submitter = AsyncSubmitter(
+                max_in_flight_per_class=FHIR_ASYNC_MAX_IN_FLIGHT_PER_CLASS,
+                max_in_flight_per_host=FHIR_ASYNC_MAX_IN_FLIGHT_PER_HOST,
+                headers=headers,
+                auth=auth,
+                post_fallback=FHIR_ID_STRATEGY != "deterministic",
+            )
+        return _async_submitter
+
+
+def _submit_rest(entity_class, host, body, headers, auth=None):
     resp = None
     api_path = entity_class.api_path
     resource_id = body.get("id")
 
-    if resource_id:
-        resp = _PUT(host, api_path, resource_id, body, headers, auth=auth)
-        if (resp.status_code not in {200, 201}) and (
-            "no resource with this ID exists"
-            in resp.get("issue", [{}])[0].get("diagnostics", "")
-        ):
-            resp = None
+    if FHIR_ID_STRATEGY == "deterministic":
+        # The ID is ours to assign, so PUT creates or updates in one request
+        resp = _PUT(host, api_path, not_none(resource_id), body, headers, auth=auth)
     else:
-        body.pop("id", None)
+        if resource_id:
+            resp = _PUT(host, api_path, resource_id, body, headers, auth=auth)
+            if (resp.status_code not in {200, 201}) and (
+                NO_RESOURCE_WITH_ID in response_diagnostics(resp)
+            ):
+                # The ID came from a lookup or the ID cache but is gone from
+                # the server, so create the resource anew
+                forget_target_id(host, api_path, resource_id)
+                resp = None
+        else:
+            body.pop("id", None)
 
-    if not resp:
-        resp = _POST(host, api_path, body, headers, auth=auth)
+        if not resp:
+            resp = _POST(host, api_path, body, headers, auth=auth)
 
     if resp.status_code in {200, 201}:
-        return resp.json()["id"]
+        return response_resource_id(resp)
     else:
-        raise RequestException(f"Sent to /{api_path}:\n{body}\nGot:\n{resp.text}")
+        raise RequestException(
+            f"Sent to /{api_path}:\n{body}\nGot:\n{resp.text}", response=resp
+        )
+
+
+def _send(entity_class, host, body, headers, auth=None):
+    if FHIR_SUBMIT_MODE == "async":
+        return get_async_submitter().submit_threadsafe(entity_class, host, body)
+
+    if FHIR_SUBMIT_MODE == "conditional":
+        return _submit_conditional(entity_class, host, body, headers, auth=auth)
+
+    return _submit_rest(entity_class, host, body, headers, auth=auth)
+
+
+def submit_resource(entity_class, host, body):
+    """Sends one resource to the target service, raising if it fails.
+
+    A resource in a Bundle that submit doesn't wait for is only recorded
+    (content hash, target ID, metrics) once the server has accepted it. If
+    the server rejects it, the next submit raises BundleErrors instead.
+
+    :param entity_class: Which entity class is being sent
+    :type entity_class: class
+    :param host: A host url
+    :type host: str
+    :param body: Map between entity keys and values
+    :type body: dict
+    :raise: RequestException on error
+    :return: The target entity ID that the service says was created or updated
+    :rtype: str
+    """
+    if exporter is not None:
+        submit_counts.count(entity_class)
+        metrics.record_submit(entity_class)
+        return exporter.write(body)
+
+    headers, auth = request_config()
+
+    if content_hashes is not None and content_hashes.is_unchanged(host, body):
+        submit_counts.count(entity_class, skipped=True)
+        metrics.record_submit(entity_class)
+        return body["id"]
+
+    if FHIR_GROUP_PATCH and entity_class is Group and body.get("id"):
+        resource_id = _patch_group(host, body, headers, auth=auth)
+        if resource_id:
+            _record_sent(entity_class, host, body, resource_id)
+            return resource_id
+
+    if FHIR_SUBMIT_MODE in BUNDLE_TYPES:
+        # Recorded by _bundle_success once the server has answered
+        return _get_bundle_submitter(host, headers, auth=auth).submit(
+            entity_class, body
+        )
+
+    resource_id = _send(entity_class, host, body, headers, auth=auth)
+    _record_sent(entity_class, host, body, resource_id)
+    return resource_id
+
+
+def _record_sent(entity_class, host, body, resource_id):
+    submit_counts.count(entity_class)
+    metrics.record_submit(entity_class)
+    remember_target_id(host, entity_class.api_path, body, resource_id)
+    if content_hashes is not None:
+        content_hashes.remember(host, body, resource_id)
+
+
+def _dead_letter(entity_class, host, body, error):
+    try:
+        key_components = entity_class.get_key_components_from_body(body)
+    except (KeyError, IndexError, ValueError):
+        key_components = None
+    dead_letters.write(entity_class, host, body, error, key_components)
+    logger.warning(
+        f"Failed to submit a {entity_class.api_path}, "
+        f"wrote it to {dead_letters.path}"
+    )
+
+
+def submit(entity_class, host, body):
+    """Negotiates submitting the data for an entity to the target service.
+
+    When FHIR_DEAD_LETTER_PATH is set, a resource that the service rejects is
+    written to the dead-letter file instead of aborting the load, and so are
+    the records of entities that reference it (see
+    skip_dead_lettered_references).
+
+    :param entity_class: Which entity class is being sent
+    :type entity_class: class
+    :param host: A host url
+    :type host: str
+    :param body: Map between entity keys and values
+    :type body: dict
+    :raise: RequestException on error, unless dead-lettering is on
+    :return: The target entity ID that the service says was created or
+        updated, or None if the resource was dead-lettered
+    :rtype: str
+    """
+    if DEAD_LETTERED in body:
+        skipped = body[DEAD_LETTERED]
+        metrics.record_submit(entity_class, ok=False)
+        dead_letters.write_skipped(
+            entity_class,
+            host,
+            skipped["record"],
+            DependencyDeadLettered(skipped["error"]),
+        )
+        logger.warning(
+            f"Skipped a {entity_class.api_path} that references a dead-lettered "
+            f"resource, wrote its record to {dead_letters.path}"
+        )
+        return None
+
+    try:
+        return submit_resource(entity_class, host, body)
+    except BundleErrors:
+        # Earlier resources, already counted and not dead-lettered
+        raise
+    except (RequestException, *ASYNC_ERRORS) as e:
+        metrics.record_submit(entity_class, ok=False)
+        if dead_letters is None:
+            raise
+        _dead_letter(entity_class, host, body, e)
+        return None
+
+
+def skip_dead_lettered_references(entity_class):
+    """Makes an entity class skip the records that reference a resource
+    dead-lettered earlier in the load, which has no target ID.
+
+    Such a record gets placeholder key components, no target ID lookup, and a
+    placeholder body that submit writes to the dead-letter file along with the
+    record. The skipped entity then counts as dead-lettered itself, so the
+    entities referencing it are skipped in turn.
+
+    :param entity_class: Which entity class to guard
+    :type entity_class: class
+    """
+    get_key_components = entity_class.get_key_components
+    build_entity = entity_class.build_entity
+
+    def guard(get_target_id_from_record):
+        def guarded(cls, record):
+            target_id = get_target_id_from_record(cls, record)
+            if target_id is None:
+                try:
+                    key_components = _unguarded_key_components[cls](
+                        record, get_target_id_from_record
+                    )
+                except (KeyError, IndexError, ValueError):
+                    key_components = None
+                if key_components and dead_letters.has_failed(cls, key_components):
+                    raise DependencyDeadLettered(
+                        f"References a {cls.class_name} that was dead-lettered: "
+                        f"{key_components}"
+                    )
+            return target_id
+
+        return guarded
+
+    def guarded_key_components(cls, record, get_target_id_from_record):
+        try:
+            return get_key_components(record, guard(get_target_id_from_record))
+        except DependencyDeadLettered as e:
+            return {DEAD_LETTERED: str(e)}
+
+    def guarded_build_entity(cls, record, get_target_id_from_record):
+        key_components = cls.get_key_components(record, get_target_id_from_record)
+        try:
+            if DEAD_LETTERED in key_components:
+                raise DependencyDeadLettered(key_components[DEAD_LETTERED])
+            return build_entity(record, guard(get_target_id_from_record))
+        except DependencyDeadLettered as e:
+            dead_letters.mark_failed(cls, key_components)
+            return {
+                "resourceType": cls.api_path,
+                DEAD_LETTERED: {"error": str(e), "record": dict(record)},
+            }
+
+    _unguarded_key_components[entity_class] = get_key_components
+    entity_class.get_key_components = classmethod(guarded_key_components)
+    entity_class.build_entity = classmethod(guarded_build_entity)
+
+    query_target_ids = getattr(entity_class, "query_target_ids", None)
+    if query_target_ids is not None:
+
+        def guarded_query_target_ids(cls, host, key_components):
+            if DEAD_LETTERED in key_components:
+                return []
+            return query_target_ids(host, key_components)
+
+        entity_class.query_target_ids = classmethod(guarded_query_target_ids)
 
 
 # Override submitter
@@ -131,3 +627,7 @@ all_targets = [
     Specimen,
     DocumentReference,
 ]
+
+if dead_letters is not None:
+    for entity_class in all_targets:
+        skip_dead_lettered_references(entity_class)
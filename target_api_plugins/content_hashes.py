@@ -0,0 +1,167 @@
+"""
+Remembers a hash of the last body successfully submitted for each FHIR
+resource, so that unchanged resources aren't sent again on the next run.
+
+Forget stored hashes (forcing the next run to resend) with:
+
+    python -m target_api_plugins.content_hashes forget STORE_PATH \\
+        --target_url URL [--resource_type TYPE]
+"""
+import argparse
+import atexit
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(body):
+    """Hashes the canonical JSON form of a FHIR resource."""
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ContentHashStore:
+    """Maps (target URL, resource type, resource ID) to the hash of the last
+    body that the server accepted for that resource.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the SQLite database file, created if missing
+        :type path: str
+        """
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS content_hashes ("
+                " host TEXT NOT NULL,"
+                " resource_type TEXT NOT NULL,"
+                " resource_id TEXT NOT NULL,"
+                " hash TEXT NOT NULL,"
+                " PRIMARY KEY (host, resource_type, resource_id))"
+            )
+
+    def is_unchanged(self, host, body):
+        """Whether the server already has exactly this body.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param body: FHIR resource with an ID
+        :type body: dict
+        :rtype: bool
+        """
+        resource_id = body.get("id")
+        if not resource_id:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT hash FROM content_hashes"
+                " WHERE host = ? AND resource_type = ? AND resource_id = ?",
+                (host.rstrip("/"), body["resourceType"], resource_id),
+            ).fetchone()
+        return row is not None and row[0] == content_hash(body)
+
+    def remember(self, host, body, resource_id):
+        """Stores the hash of a body that the server accepted as resource_id."""
+        body = dict(body, id=resource_id)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO content_hashes"
+                " (host, resource_type, resource_id, hash) VALUES (?, ?, ?, ?)",
+                (
+                    host.rstrip("/"),
+                    body["resourceType"],
+                    resource_id,
+                    content_hash(body),
+                ),
+            )
+
+    def forget(self, host, resource_type=None):
+        """Drops stored hashes for a target URL, optionally only those of one
+        resource type.
+
+        :return: number of hashes dropped
+        :rtype: int
+        """
+        query = "DELETE FROM content_hashes WHERE host = ?"
+        params = [host.rstrip("/")]
+        if resource_type is not None:
+            query += " AND resource_type = ?"
+            params.append(resource_type)
+        with self._lock, self._conn:
+            return self._conn.execute(query, params).rowcount
+
+
+class SubmitCounts:
+    """Counts, per entity class, the resources sent and the unchanged
+    resources skipped during this run.
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.skipped = {}
+        self._lock = threading.Lock()
+
+    def count(self, entity_class, skipped=False):
+        counts = self.skipped if skipped else self.sent
+        with self._lock:
+            counts[entity_class.class_name] = counts.get(entity_class.class_name, 0) + 1
+
+    def summary(self):
+        """
+        :return: map from entity class name to its sent and skipped counts
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                name: {
+                    "sent": self.sent.get(name, 0),
+                    "skipped": self.skipped.get(name, 0),
+                }
+                for name in sorted(set(self.sent) | set(self.skipped))
+            }
+
+    def log_summary(self):
+        for name, counts in self.summary().items():
+            logger.info(
+                f"{name}: sent {counts['sent']}, "
+                f"skipped {counts['skipped']} unchanged"
+            )
+
+
+submit_counts = SubmitCounts()
+atexit.register(submit_counts.log_summary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Manage the stored hashes of submitted FHIR resources."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    forget = subparsers.add_parser(
+        "forget", help="Drop stored hashes so those resources are resent."
+    )
+    forget.add_argument("store_path", help="Path of the SQLite hash store")
+    forget.add_argument("--target_url", required=True)
+    forget.add_argument("--resource_type", help="Only drop hashes of this type")
+    args = parser.parse_args(argv)
+
+    dropped = ContentHashStore(args.store_path).forget(
+        args.target_url, resource_type=args.resource_type
+    )
+    print(f"Dropped {dropped} stored hashes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Keeps resources that the FHIR service rejected in a local dead-letter file,
+so a load can go on past them and only they need to be resubmitted later.
+
+Resubmit dead-lettered resources with:
+
+    python -m target_api_plugins.dead_letter replay DEAD_LETTER_PATH \\
+        [--target_url URL]
+
+Resources that fail again stay in the file.
+
+Records that couldn't be built because they reference a dead-lettered
+resource are kept in the file too, without a body. Load them again once the
+resources they reference are in.
+"""
+import argparse
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+from target_api_plugins.id_cache import canonical_key
+
+# Body key that marks an entity skipped because it references a resource
+# that was dead-lettered
+DEAD_LETTERED = "_dead_lettered"
+
+
+class DependencyDeadLettered(ValueError):
+    """Raised while building an entity that references a dead-lettered
+    resource, which has no target ID to reference.
+    """
+
+
+class DeadLetterQueue:
+    """Appends failed submits to a JSON lines file."""
+
+    def __init__(self, path):
+        """
+        :param path: Path of the dead-letter file, created if missing
+        :type path: str
+        """
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._failed_keys = set()
+
+    def write(self, entity_class, host, body, error, key_components=None):
+        """Records a resource that could not be submitted.
+
+        :param entity_class: Which entity class was being sent
+        :type entity_class: class
+        :param host: A host url
+        :type host: str
+        :param body: FHIR resource
+        :type body: dict
+        :param error: The exception raised while submitting
+        :type error: Exception
+        :param key_components: The resource's key components, remembered so
+            that entities referencing it can be skipped
+        :type key_components: dict
+        """
+        if key_components is not None:
+            self.mark_failed(entity_class, key_components)
+        self._append(self._record(entity_class, host, body, error))
+
+    def write_skipped(self, entity_class, host, record, error):
+        """Records an entity that wasn't built because it references a
+        dead-lettered resource.
+
+        :param record: The record the entity would have been built from
+        :type record: dict
+        """
+        line = self._record(entity_class, host, None, error)
+        line["record"] = record
+        self._append(line)
+
+    def _append(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def mark_failed(self, entity_class, key_components):
+        """Remembers the key of an entity that didn't make it to the server
+        during this run.
+        """
+        with self._lock:
+            self._failed_keys.add(
+                (entity_class.class_name, canonical_key(key_components))
+            )
+
+    def has_failed(self, entity_class, key_components):
+        """Whether an entity was dead-lettered or skipped during this run."""
+        if DEAD_LETTERED in key_components:
+            return True
+        with self._lock:
+            return (
+                entity_class.class_name,
+                canonical_key(key_components),
+            ) in self._failed_keys
+
+    @staticmethod
+    def _record(entity_class, host, body, error):
+        response = getattr(error, "response", None)
+        return {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "entity_class": entity_class.class_name,
+            "api_path": entity_class.api_path,
+            "host": host,
+            "status": response.status_code if response is not None else None,
+            "response": response.text if response is not None else None,
+            "error": str(error),
+            "body": body,
+        }
+
+    def read(self):
+        """Yields the dead-lettered records in the order they were written."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def replay(self, entity_classes, submit_resource, host=None):
+        """Resubmits every dead-lettered resource. Those that fail again are
+        kept in the file and the rest are removed from it.
+
+        :param entity_classes: Entity classes to look records up by class_name
+        :type entity_classes: list
+        :param submit_resource: Function (entity_class, host, body) -> ID that
+            raises on failure
+        :type submit_resource: function
+        :param host: Target URL to send to instead of the recorded one
+        :type host: str
+        :return: (number resubmitted, number still failing or skipped)
+        :rtype: tuple
+        """
+        classes = {cls.class_name: cls for cls in entity_classes}
+        with self._lock:
+            records = list(self.read())
+            remaining = []
+            for record in records:
+                entity_class = classes[record["entity_class"]]
+                if record["body"] is None:
+                    # Skipped while building; only a new load can build it
+                    remaining.append(record)
+                    continue
+                try:
+                    submit_resource(
+                        entity_class, host or record["host"], record["body"]
+                    )
+                except Exception as e:
+                    remaining.append(
+                        self._record(entity_class, record["host"], record["body"], e)
+                    )
+
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                for record in remaining:
+                    f.write(json.dumps(record, default=str) + "\n")
+            os.replace(tmp_path, self.path)
+
+        return len(records) - len(remaining), len(remaining)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Manage resources that failed to load into the FHIR service."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay = subparsers.add_parser("replay", help="Resubmit dead-lettered resources.")
+    replay.add_argument("dead_letter_path", help="Path of the dead-letter file")
+    replay.add_argument(
+        "--target_url", help="Send to this URL instead of the recorded one"
+    )
+    args = parser.parse_args(argv)
+
+    from target_api_plugins.clovoc_api_fhir_service import (
+        all_targets,
+        submit_resource,
+    )
+
+    resubmitted, failed = DeadLetterQueue(args.dead_letter_path).replay(
+        all_targets, submit_resource, host=args.target_url
+    )
+    print(
+        f"Resubmitted {resubmitted} resources, "
+        f"{failed} still failing or waiting for a new load"
+    )
+
+
+if __name__ == "__main__":
+    main()
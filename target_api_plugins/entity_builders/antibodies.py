@@ -4,12 +4,16 @@ from rows of tabular antibodies data.
 """
 from abc import abstractmethod
 
+import numpy as np
 import pandas as pd
 
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.streaming import is_stream, iter_frames
+from target_api_plugins.templates import Slot, Template
+from target_api_plugins.utils import identifier_key_components, not_none
 
 # http://hl7.org/fhir/ValueSet/observation-status
 status_code = "final"
@@ -35,103 +39,24 @@ class Antibodies:
     api_path = "Observation"
     target_id_concept = None
     service_id_fields = None
+    group_keys = [
+        CONCEPT.PARTICIPANT.ID,
+        CONCEPT.OBSERVATION.NAME,
+        CONCEPT.OBSERVATION.ONTOLOGY_CODE,
+        CONCEPT.OBSERVATION.EVENT_AGE.VALUE,
+        CONCEPT.OBSERVATION.EVENT_AGE.UNITS,
+        CONCEPT.OBSERVATION.INTERPRETATION,
+    ]
 
-    @classmethod
-    def transform_records_list(cls, records_list):
-        df = pd.DataFrame(records_list)
-        df = df[df[CONCEPT.OBSERVATION.NAME].isin(["GAD", "IA2A", "MIAA"])]
-        transformed_records = []
-        for names, group in df.groupby(
-            by=[
-                CONCEPT.PARTICIPANT.ID,
-                CONCEPT.OBSERVATION.NAME,
-                CONCEPT.OBSERVATION.ONTOLOGY_CODE,
-                CONCEPT.OBSERVATION.EVENT_AGE.VALUE,
-                CONCEPT.OBSERVATION.EVENT_AGE.UNITS,
-                CONCEPT.OBSERVATION.INTERPRETATION,
-            ]
-        ):
-            record = {
-                CONCEPT.PARTICIPANT.ID: names[0],
-                CONCEPT.OBSERVATION.NAME: names[1],
-                CONCEPT.OBSERVATION.ONTOLOGY_CODE: names[2],
-                CONCEPT.OBSERVATION.EVENT_AGE.VALUE: names[3],
-                CONCEPT.OBSERVATION.EVENT_AGE.UNITS: names[4],
-                CONCEPT.OBSERVATION.INTERPRETATION: names[5],
-            }
-            component_list = []
-            for _, row in group.iterrows():
-                name, value, units = row.get(
-                    [
-                        "OBSERVATION|COMPONENT|NAME",
-                        "OBSERVATION|QUANTITY|VALUE",
-                        "OBSERVATION|QUANTITY|UNITS",
-                    ]
-                )
-                component_list.append(
-                    {
-                        "OBSERVATION|COMPONENT|NAME": name,
-                        "OBSERVATION|QUANTITY|VALUE": value,
-                        "OBSERVATION|QUANTITY|UNITS": units,
-                    }
-                )
-            record["OBSERVATION|COMPONENT"] = component_list
-            transformed_records.append(record)
-
-        return transformed_records
-
-    @classmethod
-    def get_key_components(cls, record, get_target_id_from_record):
-        participant_id = not_none(record[CONCEPT.PARTICIPANT.ID])
-        observation_name = not_none(record[CONCEPT.OBSERVATION.NAME])
-        event_age_value = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE])
-        event_age_units = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS])
-
-        return {
-            "identifier": "-".join(
-                [
-                    participant_id,
-                    observation_name,
-                    event_age_value,
-                    event_age_units,
-                ]
-            )
-        }
-
-    @classmethod
-    def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
-
-    @classmethod
-    def build_entity(cls, record, get_target_id_from_record):
-        study_id = record[CONCEPT.PROJECT.ID]
-        participant_id = record[CONCEPT.PARTICIPANT.ID]
-        observation_name = record[CONCEPT.OBSERVATION.NAME]
-        ontology_code = record[CONCEPT.OBSERVATION.ONTOLOGY_CODE]
-        event_age_value = record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE]
-        event_age_units = record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS]
-        interpretation = record[CONCEPT.OBSERVATION.INTERPRETATION]
-        component_list = record["OBSERVATION|COMPONENT"]
-
-        entity = {
-            "resourceType": cls.api_path,
-            "id": get_target_id_from_record(cls, record),
+    template = Template(
+        {
+            "resourceType": api_path,
+            "id": Slot("id"),
             "meta": {
-                "profile": [f"http://hl7.org/fhir/StructureDefinition/{cls.api_path}"],
-                "tag": [{"code": study_id}],
+                "profile": [f"http://hl7.org/fhir/StructureDefinition/{api_path}"],
+                "tag": [{"code": Slot("study_id")}],
             },
-            "identifier": [
-                {
-                    "value": "-".join(
-                        [
-                            participant_id,
-                            observation_name,
-                            event_age_value,
-                            event_age_units,
-                        ]
-                    )
-                }
-            ],
+            "identifier": [{"value": Slot("identifier")}],
             "status": status_code,
             "category": [
                 {
@@ -149,37 +74,19 @@ class Antibodies:
                 "coding": [
                     {
                         "system": "http://loinc.org",
-                        "code": ontology_code,
+                        "code": Slot("code"),
                     }
                 ],
-                "text": observation_name,
-            },
-            "subject": {
-                "reference": "/".join(
-                    [
-                        Patient.api_path,
-                        not_none(get_target_id_from_record(Patient, record)),
-                    ]
-                )
+                "text": Slot("name"),
             },
+            "subject": {"reference": Slot("subject")},
             "_effectiveDateTime": {
                 "extension": [
                     {
                         "extension": [
                             {
                                 "url": "target",
-                                "valueReference": {
-                                    "reference": "/".join(
-                                        [
-                                            Patient.api_path,
-                                            not_none(
-                                                get_target_id_from_record(
-                                                    Patient, record
-                                                )
-                                            ),
-                                        ]
-                                    )
-                                },
+                                "valueReference": {"reference": Slot("subject")},
                             },
                             {
                                 "url": "targetPath",
@@ -192,10 +99,10 @@ class Antibodies:
                             {
                                 "url": "offset",
                                 "valueDuration": {
-                                    "value": int(event_age_value),
-                                    "unit": age_units_to_unit[event_age_units],
+                                    "value": Slot("age_value"),
+                                    "unit": Slot("age_unit"),
                                     "system": "http://unitsofmeasure.org",
-                                    "code": age_units_to_code[event_age_units],
+                                    "code": Slot("age_code"),
                                 },
                             },
                         ],
@@ -205,11 +112,145 @@ class Antibodies:
             },
             "interpretation": [
                 {
-                    "coding": [interpretation_coding[interpretation]],
-                    "text": interpretation,
+                    "coding": [Slot("interpretation_coding")],
+                    "text": Slot("interpretation"),
                 }
             ],
         }
+    )
+
+    @classmethod
+    def transform_records_list(cls, records_list):
+        if is_stream(records_list):
+            return cls._transform_stream(records_list)
+
+        df = pd.DataFrame(records_list)
+        return [cls._record(names, components) for names, components in cls._groups(df)]
+
+    @classmethod
+    def _transform_stream(cls, records):
+        # A group's rows can be spread over many chunks, so groups are only
+        # complete once all chunks are read. Until then only the components
+        # of the kept rows are held.
+        groups = {}
+        columns = cls.group_keys + [
+            "OBSERVATION|COMPONENT|NAME",
+            "OBSERVATION|QUANTITY|VALUE",
+            "OBSERVATION|QUANTITY|UNITS",
+        ]
+        for df in iter_frames(records, columns=columns):
+            for names, components in cls._groups(df):
+                groups.setdefault(names, []).extend(components)
+        for names in sorted(groups):
+            yield cls._record(names, groups.pop(names))
+
+    @classmethod
+    def _record(cls, names, components):
+        record = dict(zip(cls.group_keys, names))
+        record["OBSERVATION|COMPONENT"] = components
+        return record
+
+    @classmethod
+    def _groups(cls, df):
+        """Yields the key values and component list of each group of rows,
+        in key order.
+        """
+        df = df[df[CONCEPT.OBSERVATION.NAME].isin(["GAD", "IA2A", "MIAA"])]
+        # groupby leaves out rows with a missing key
+        df = df.dropna(subset=cls.group_keys)
+        if df.empty:
+            return
+
+        # Sort the rows by group, in key order, keeping the order of rows
+        # within a group, and cut the component columns at the group edges
+        groups = df.groupby(by=cls.group_keys).ngroup().to_numpy()
+        order = np.argsort(groups, kind="stable")
+        groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        ends = np.r_[starts[1:], len(groups)]
+
+        def column(name):
+            return df[name].to_numpy(dtype=object)[order]
+
+        components = [
+            {
+                "OBSERVATION|COMPONENT|NAME": name,
+                "OBSERVATION|QUANTITY|VALUE": value,
+                "OBSERVATION|QUANTITY|UNITS": units,
+            }
+            for name, value, units in zip(
+                column("OBSERVATION|COMPONENT|NAME"),
+                column("OBSERVATION|QUANTITY|VALUE"),
+                column("OBSERVATION|QUANTITY|UNITS"),
+            )
+        ]
+        for start, end, *names in zip(
+            starts, ends, *(column(key)[starts] for key in cls.group_keys)
+        ):
+            yield tuple(names), components[start:end]
+
+    @classmethod
+    def get_key_components(cls, record, get_target_id_from_record):
+        participant_id = not_none(record[CONCEPT.PARTICIPANT.ID])
+        observation_name = not_none(record[CONCEPT.OBSERVATION.NAME])
+        event_age_value = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE])
+        event_age_units = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS])
+
+        return {
+            "identifier": "-".join(
+                [
+                    participant_id,
+                    observation_name,
+                    event_age_value,
+                    event_age_units,
+                ]
+            )
+        }
+
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
+    @classmethod
+    def query_target_ids(cls, host, key_components):
+        return resolve_target_ids(host, cls.api_path, key_components)
+
+    @classmethod
+    def build_entity(cls, record, get_target_id_from_record):
+        study_id = record[CONCEPT.PROJECT.ID]
+        participant_id = record[CONCEPT.PARTICIPANT.ID]
+        observation_name = record[CONCEPT.OBSERVATION.NAME]
+        ontology_code = record[CONCEPT.OBSERVATION.ONTOLOGY_CODE]
+        event_age_value = record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE]
+        event_age_units = record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS]
+        interpretation = record[CONCEPT.OBSERVATION.INTERPRETATION]
+        component_list = record["OBSERVATION|COMPONENT"]
+
+        entity = cls.template.render(
+            id=get_target_id_from_record(cls, record),
+            study_id=study_id,
+            identifier="-".join(
+                [
+                    participant_id,
+                    observation_name,
+                    event_age_value,
+                    event_age_units,
+                ]
+            ),
+            code=ontology_code,
+            name=observation_name,
+            subject="/".join(
+                [
+                    Patient.api_path,
+                    not_none(get_target_id_from_record(Patient, record)),
+                ]
+            ),
+            age_value=int(event_age_value),
+            age_unit=age_units_to_unit[event_age_units],
+            age_code=age_units_to_code[event_age_units],
+            interpretation_coding=interpretation_coding[interpretation],
+            interpretation=interpretation,
+        )
 
         for component in component_list:
             entity.setdefault("component", []).append(
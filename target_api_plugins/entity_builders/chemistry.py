@@ -9,7 +9,10 @@ import pandas as pd
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.streaming import filter_records, is_stream
+from target_api_plugins.templates import Slot, Template
+from target_api_plugins.utils import identifier_key_components, not_none
 
 # http://hl7.org/fhir/ValueSet/observation-status
 status_code = "final"
@@ -27,72 +30,15 @@ class Chemistry:
     target_id_concept = None
     service_id_fields = None
 
-    @classmethod
-    def transform_records_list(cls, records_list):
-        df = pd.DataFrame(records_list)
-        df = df[
-            (df[CONCEPT.OBSERVATION.NAME] == "HbA1c")
-            | (df[CONCEPT.OBSERVATION.NAME].str.startswith("OGTTPEP"))
-            | (df[CONCEPT.OBSERVATION.NAME].str.startswith("GLU"))
-            | (df[CONCEPT.OBSERVATION.NAME].str.startswith("OGTTINS"))
-            | (df[CONCEPT.OBSERVATION.NAME].str.startswith("OGTTGLU"))
-        ]
-
-        return df.to_dict("records")
-
-    @classmethod
-    def get_key_components(cls, record, get_target_id_from_record):
-        participant_id = not_none(record[CONCEPT.PARTICIPANT.ID])
-        observation_name = not_none(record[CONCEPT.OBSERVATION.NAME])
-        event_age_value = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE])
-        event_age_units = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS])
-
-        return {
-            "identifier": "-".join(
-                [
-                    participant_id,
-                    observation_name,
-                    event_age_value,
-                    event_age_units,
-                ]
-            )
-        }
-
-    @classmethod
-    def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
-
-    @classmethod
-    def build_entity(cls, record, get_target_id_from_record):
-        study_id = record[CONCEPT.PROJECT.ID]
-        participant_id = record[CONCEPT.PARTICIPANT.ID]
-        observation_name = record[CONCEPT.OBSERVATION.NAME]
-        ontology_uri = record[CONCEPT.OBSERVATION.ONTOLOGY_ONTOBEE_URI]
-        ontology_code = record[CONCEPT.OBSERVATION.ONTOLOGY_CODE]
-        event_age_value = record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE]
-        event_age_units = record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS]
-        value = record["OBSERVATION|QUANTITY|VALUE"]
-        units = record["OBSERVATION|QUANTITY|UNITS"]
-
-        entity = {
-            "resourceType": cls.api_path,
-            "id": get_target_id_from_record(cls, record),
+    template = Template(
+        {
+            "resourceType": api_path,
+            "id": Slot("id"),
             "meta": {
-                "profile": [f"http://hl7.org/fhir/StructureDefinition/{cls.api_path}"],
-                "tag": [{"code": study_id}],
+                "profile": [f"http://hl7.org/fhir/StructureDefinition/{api_path}"],
+                "tag": [{"code": Slot("study_id")}],
             },
-            "identifier": [
-                {
-                    "value": "-".join(
-                        [
-                            participant_id,
-                            observation_name,
-                            event_age_value,
-                            event_age_units,
-                        ]
-                    )
-                }
-            ],
+            "identifier": [{"value": Slot("identifier")}],
             "status": status_code,
             "category": [
                 {
@@ -109,38 +55,20 @@ class Chemistry:
             "code": {
                 "coding": [
                     {
-                        "system": ontology_uri,
-                        "code": ontology_code,
+                        "system": Slot("code_system"),
+                        "code": Slot("code"),
                     }
                 ],
-                "text": observation_name,
-            },
-            "subject": {
-                "reference": "/".join(
-                    [
-                        Patient.api_path,
-                        not_none(get_target_id_from_record(Patient, record)),
-                    ]
-                )
+                "text": Slot("name"),
             },
+            "subject": {"reference": Slot("subject")},
             "_effectiveDateTime": {
                 "extension": [
                     {
                         "extension": [
                             {
                                 "url": "target",
-                                "valueReference": {
-                                    "reference": "/".join(
-                                        [
-                                            Patient.api_path,
-                                            not_none(
-                                                get_target_id_from_record(
-                                                    Patient, record
-                                                )
-                                            ),
-                                        ]
-                                    )
-                                },
+                                "valueReference": {"reference": Slot("subject")},
                             },
                             {
                                 "url": "targetPath",
@@ -153,10 +81,10 @@ class Chemistry:
                             {
                                 "url": "offset",
                                 "valueDuration": {
-                                    "value": int(event_age_value),
-                                    "unit": age_units_to_unit[event_age_units],
+                                    "value": Slot("age_value"),
+                                    "unit": Slot("age_unit"),
                                     "system": "http://unitsofmeasure.org",
-                                    "code": age_units_to_code[event_age_units],
+                                    "code": Slot("age_code"),
                                 },
                             },
                         ],
@@ -165,6 +93,94 @@ class Chemistry:
                 ]
             },
         }
+    )
+
+    @classmethod
+    def transform_records_list(cls, records_list):
+        if is_stream(records_list):
+            return filter_records(
+                records_list, cls._keep, columns=[CONCEPT.OBSERVATION.NAME]
+            )
+
+        df = pd.DataFrame(records_list)
+        df = df[cls._keep(df)]
+
+        return df.to_dict("records")
+
+    @staticmethod
+    def _keep(df):
+        # A chunk without any names has a float column, without .str
+        names = df[CONCEPT.OBSERVATION.NAME].fillna("").astype(str)
+        return (
+            (names == "HbA1c")
+            | (names.str.startswith("OGTTPEP"))
+            | (names.str.startswith("GLU"))
+            | (names.str.startswith("OGTTINS"))
+            | (names.str.startswith("OGTTGLU"))
+        )
+
+    @classmethod
+    def get_key_components(cls, record, get_target_id_from_record):
+        participant_id = not_none(record[CONCEPT.PARTICIPANT.ID])
+        observation_name = not_none(record[CONCEPT.OBSERVATION.NAME])
+        event_age_value = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE])
+        event_age_units = not_none(record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS])
+
+        return {
+            "identifier": "-".join(
+                [
+                    participant_id,
+                    observation_name,
+                    event_age_value,
+                    event_age_units,
+                ]
+            )
+        }
+
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
+    @classmethod
+    def query_target_ids(cls, host, key_components):
+        return resolve_target_ids(host, cls.api_path, key_components)
+
+    @classmethod
+    def build_entity(cls, record, get_target_id_from_record):
+        study_id = record[CONCEPT.PROJECT.ID]
+        participant_id = record[CONCEPT.PARTICIPANT.ID]
+        observation_name = record[CONCEPT.OBSERVATION.NAME]
+        ontology_uri = record[CONCEPT.OBSERVATION.ONTOLOGY_ONTOBEE_URI]
+        ontology_code = record[CONCEPT.OBSERVATION.ONTOLOGY_CODE]
+        event_age_value = record[CONCEPT.OBSERVATION.EVENT_AGE.VALUE]
+        event_age_units = record[CONCEPT.OBSERVATION.EVENT_AGE.UNITS]
+        value = record["OBSERVATION|QUANTITY|VALUE"]
+        units = record["OBSERVATION|QUANTITY|UNITS"]
+
+        entity = cls.template.render(
+            id=get_target_id_from_record(cls, record),
+            study_id=study_id,
+            identifier="-".join(
+                [
+                    participant_id,
+                    observation_name,
+                    event_age_value,
+                    event_age_units,
+                ]
+            ),
+            code_system=ontology_uri,
+            code=ontology_code,
+            name=observation_name,
+            subject="/".join(
+                [
+                    Patient.api_path,
+                    not_none(get_target_id_from_record(Patient, record)),
+                ]
+            ),
+            age_value=int(event_age_value),
+            age_unit=age_units_to_unit[event_age_units],
+            age_code=age_units_to_code[event_age_units],
+        )
 
         # valueQuantity
         value_quantity = {"system": "http://unitsofmeasure.org"}
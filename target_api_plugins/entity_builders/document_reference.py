@@ -6,7 +6,8 @@ from abc import abstractmethod
 
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.utils import identifier_key_components, not_none
 
 # http://hl7.org/fhir/ValueSet/document-reference-status
 status_code = "current"
@@ -34,9 +35,13 @@ class DocumentReference:
     def get_key_components(cls, record, get_target_id_from_record):
         return {"identifier": not_none(record[CONCEPT.GENOMIC_FILE.ID])}
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return resolve_target_ids(host, cls.api_path, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
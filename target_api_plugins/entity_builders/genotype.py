@@ -9,7 +9,9 @@ import pandas as pd
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.streaming import filter_records, is_stream
+from target_api_plugins.utils import identifier_key_components, not_none
 
 # http://hl7.org/fhir/ValueSet/observation-status
 status_code = "final"
@@ -23,11 +25,20 @@ class Genotype:
 
     @classmethod
     def transform_records_list(cls, records_list):
+        if is_stream(records_list):
+            return filter_records(
+                records_list, cls._keep, columns=[CONCEPT.OBSERVATION.ONTOLOGY_CODE]
+            )
+
         df = pd.DataFrame(records_list)
-        df = df[df[CONCEPT.OBSERVATION.ONTOLOGY_CODE] == "84413-4"]
+        df = df[cls._keep(df)]
 
         return df.to_dict("records")
 
+    @staticmethod
+    def _keep(df):
+        return df[CONCEPT.OBSERVATION.ONTOLOGY_CODE] == "84413-4"
+
     @classmethod
     def get_key_components(cls, record, get_target_id_from_record):
         participant_id = not_none(record[CONCEPT.PARTICIPANT.ID])
@@ -35,6 +46,14 @@ class Genotype:
 
         return {"identifier": f"{participant_id}-{observation_name}"}
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
+    @classmethod
+    def query_target_ids(cls, host, key_components):
+        return resolve_target_ids(host, cls.api_path, key_components)
+
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
         study_id = record[CONCEPT.PROJECT.ID]
@@ -2,13 +2,17 @@
 Builds FHIR ResearchStudy resources (https://www.hl7.org/fhir/researchstudy.html)
 from rows of tabular group metadata.
 """
+import json
 from abc import abstractmethod
+from collections import Counter
 
 import pandas as pd
 
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.streaming import is_stream, iter_frames
+from target_api_plugins.utils import identifier_key_components, not_none
 
 
 class Group:
@@ -19,6 +23,9 @@ class Group:
 
     @classmethod
     def transform_records_list(cls, records_list):
+        if is_stream(records_list):
+            return cls._transform_stream(records_list)
+
         return [
             {
                 CONCEPT.STUDY.ID: study_id,
@@ -33,6 +40,27 @@ class Group:
             )
         ]
 
+    @classmethod
+    def _transform_stream(cls, records):
+        # A group's members can be spread over many chunks, so groups are
+        # only complete once all chunks are read. Until then only the
+        # distinct member IDs are held.
+        members = {}
+        columns = [CONCEPT.STUDY.ID, "GROUP|NAME", CONCEPT.PARTICIPANT.ID]
+        for df in iter_frames(records, columns=columns):
+            for key, group in df.groupby([CONCEPT.STUDY.ID, "GROUP|NAME"]):
+                members.setdefault(key, {}).update(
+                    dict.fromkeys(group.get(CONCEPT.PARTICIPANT.ID).unique())
+                )
+        for study_id, name in sorted(members):
+            yield {
+                CONCEPT.STUDY.ID: study_id,
+                "GROUP|NAME": name,
+                CONCEPT.PARTICIPANT.ID: pd.Series(
+                    list(members.pop((study_id, name)))
+                ).unique(),
+            }
+
     @classmethod
     def get_key_components(cls, record, get_target_id_from_record):
         study_id = not_none(record[CONCEPT.STUDY.ID])
@@ -40,9 +68,13 @@ class Group:
 
         return {"identifier": f"{study_id}-{name}"}
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return resolve_target_ids(host, cls.api_path, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -82,6 +114,74 @@ class Group:
 
         return entity
 
+    @classmethod
+    def membership_patch(cls, current, body):
+        """Diffs a Group's desired members against its current ones on the
+        server, as JSON Patch (https://jsonpatch.com) operations that remove
+        the members no longer wanted, append the new ones, and set quantity.
+        Members that stay are kept in their current order.
+
+        :param current: The Group as it is on the server
+        :type current: dict
+        :param body: The Group as built
+        :type body: dict
+        :return: the operations (none if membership is unchanged), or None if
+            more than membership differs, or if the group gains its first or
+            loses its last member, so that the whole Group has to be sent
+        :rtype: list
+        """
+
+        def fixed_fields(group):
+            return {
+                k: v
+                for k, v in group.items()
+                if k not in {"id", "meta", "text", "member", "quantity"}
+            }
+
+        if fixed_fields(current) != fixed_fields(body):
+            return None
+        current_meta = current.get("meta", {})
+        if any(current_meta.get(k) != v for k, v in body.get("meta", {}).items()):
+            return None
+
+        current_members = current.get("member", [])
+        desired_members = body.get("member", [])
+        if not current_members or not desired_members:
+            return None if current_members or desired_members else []
+
+        # Members are matched by their whole content, counting duplicates
+        wanted = Counter(json.dumps(m, sort_keys=True) for m in desired_members)
+        removed = []
+        for index, member in enumerate(current_members):
+            key = json.dumps(member, sort_keys=True)
+            if wanted[key]:
+                wanted[key] -= 1
+            else:
+                removed.append(index)
+        added = []
+        for member in desired_members:
+            key = json.dumps(member, sort_keys=True)
+            if wanted[key]:
+                wanted[key] -= 1
+                added.append(member)
+
+        # Removing from the end first keeps the other indexes valid
+        operations = [
+            {"op": "remove", "path": f"/member/{index}"} for index in reversed(removed)
+        ]
+        operations.extend(
+            {"op": "add", "path": "/member/-", "value": member} for member in added
+        )
+        if operations or current.get("quantity") != len(desired_members):
+            operations.append(
+                {
+                    "op": "replace" if "quantity" in current else "add",
+                    "path": "/quantity",
+                    "value": len(desired_members),
+                }
+            )
+        return operations
+
     @abstractmethod
     def submit(cls, host, body):
         pass
@@ -6,7 +6,9 @@ from abc import abstractmethod
 
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.templates import Slot, Template
+from target_api_plugins.utils import not_none
 
 # http://hl7.org/fhir/us/core/ValueSet/omb-race-category
 omb_race_category = {
@@ -101,6 +103,30 @@ class Patient:
     target_id_concept = None
     service_id_fields = None
 
+    template = Template(
+        {
+            "resourceType": api_path,
+            "id": Slot("id"),
+            "meta": {
+                "profile": [f"http://hl7.org/fhir/StructureDefinition/{api_path}"],
+                "tag": [{"code": Slot("study_id")}],
+            },
+            "identifier": [{"value": Slot("identifier")}],
+        }
+    )
+    race_template = Template(
+        {
+            "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
+            "extension": [{"url": "text", "valueString": Slot("text")}],
+        }
+    )
+    ethnicity_template = Template(
+        {
+            "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity",
+            "extension": [{"url": "text", "valueString": Slot("text")}],
+        }
+    )
+
     @classmethod
     def get_key_components(cls, record, get_target_id_from_record):
         return {
@@ -108,9 +134,16 @@ class Patient:
             "identifier": not_none(record[CONCEPT.PARTICIPANT.ID]),
         }
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return {
+            "_tag": not_none(body["meta"]["tag"][0]["code"]),
+            "identifier": not_none(body["identifier"][0]["value"]),
+        }
+
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return resolve_target_ids(host, cls.api_path, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -121,42 +154,24 @@ class Patient:
         gender = record.get(CONCEPT.PARTICIPANT.GENDER)
         enrollment_age_days = record.get(CONCEPT.PARTICIPANT.ENROLLMENT_AGE_DAYS)
 
-        entity = {
-            "resourceType": cls.api_path,
-            "id": get_target_id_from_record(cls, record),
-            "meta": {
-                "profile": [f"http://hl7.org/fhir/StructureDefinition/{cls.api_path}"],
-                "tag": [{"code": study_id}],
-            },
-            "identifier": [{"value": participant_id}],
-        }
+        entity = cls.template.render(
+            id=get_target_id_from_record(cls, record),
+            study_id=study_id,
+            identifier=participant_id,
+        )
 
         # US Core Race
-        us_core_race = {}
         if race:
-            us_core_race.update(
-                {
-                    "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
-                    "extension": [{"url": "text", "valueString": race}],
-                }
-            )
+            us_core_race = cls.race_template.render(text=race)
             if omb_race_category.get(race):
                 us_core_race["extension"].append(omb_race_category[race])
-        if us_core_race:
             entity.setdefault("extension", []).append(us_core_race)
 
         # US Core Ethnicity
-        us_core_ethnicity = {}
         if ethnicity:
-            us_core_ethnicity.update(
-                {
-                    "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity",
-                    "extension": [{"url": "text", "valueString": ethnicity}],
-                }
-            )
+            us_core_ethnicity = cls.ethnicity_template.render(text=ethnicity)
             if omb_ethnicity_category.get(ethnicity):
                 us_core_ethnicity["extension"].append(omb_ethnicity_category[ethnicity])
-        if us_core_ethnicity:
             entity.setdefault("extension", []).append(us_core_ethnicity)
 
         # gender
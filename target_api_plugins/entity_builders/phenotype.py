@@ -7,7 +7,9 @@ from abc import abstractmethod
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.templates import Slot, Template
+from target_api_plugins.utils import identifier_key_components, not_none
 
 # http://hl7.org/fhir/ValueSet/condition-ver-status
 verification_status_coding = {
@@ -51,6 +53,58 @@ class Phenotype:
     target_id_concept = None
     service_id_fields = None
 
+    template = Template(
+        {
+            "resourceType": api_path,
+            "id": Slot("id"),
+            "meta": {
+                "profile": [f"http://hl7.org/fhir/StructureDefinition/{api_path}"],
+                "tag": [{"code": Slot("study_id")}],
+            },
+            "identifier": [{"value": Slot("identifier")}],
+            "verificationStatus": {
+                "coding": [Slot("verification_coding")],
+                "text": Slot("verification"),
+            },
+            "code": {"text": Slot("name")},
+            "subject": {"reference": Slot("subject")},
+        }
+    )
+
+    onset_template = Template(
+        {
+            "extension": [
+                {
+                    "extension": [
+                        {
+                            "url": "event",
+                            "valueCodeableConcept": {
+                                "coding": [
+                                    {
+                                        "system": "http://snomed.info/sct",
+                                        "code": "3950001",
+                                        "display": "Birth",
+                                    }
+                                ]
+                            },
+                        },
+                        {"url": "relationship", "valueCode": "after"},
+                        {
+                            "url": "offset",
+                            "valueDuration": {
+                                "value": Slot("value"),
+                                "unit": Slot("unit"),
+                                "system": "http://unitsofmeasure.org",
+                                "code": Slot("code"),
+                            },
+                        },
+                    ],
+                    "url": "http://hl7.org/fhir/StructureDefinition/relative-date",
+                }
+            ]
+        }
+    )
+
     @classmethod
     def get_key_components(cls, record, get_target_id_from_record):
         participant_id = not_none(record[CONCEPT.PARTICIPANT.ID])
@@ -59,9 +113,13 @@ class Phenotype:
 
         return {"identifier": f"{participant_id}-{name}-{verification}"}
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return resolve_target_ids(host, cls.api_path, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -77,28 +135,20 @@ class Phenotype:
         event_age_value = record.get(CONCEPT.PHENOTYPE.EVENT_AGE.VALUE)
         event_age_units = record.get(CONCEPT.PHENOTYPE.EVENT_AGE.UNITS)
 
-        entity = {
-            "resourceType": cls.api_path,
-            "id": get_target_id_from_record(cls, record),
-            "meta": {
-                "profile": [f"http://hl7.org/fhir/StructureDefinition/{cls.api_path}"],
-                "tag": [{"code": study_id}],
-            },
-            "identifier": [{"value": f"{participant_id}-{name}-{verification}"}],
-            "verificationStatus": {
-                "coding": [verification_status_coding[verification]],
-                "text": verification,
-            },
-            "code": {"text": name},
-            "subject": {
-                "reference": "/".join(
-                    [
-                        Patient.api_path,
-                        not_none(get_target_id_from_record(Patient, record)),
-                    ]
-                )
-            },
-        }
+        entity = cls.template.render(
+            id=get_target_id_from_record(cls, record),
+            study_id=study_id,
+            identifier=f"{participant_id}-{name}-{verification}",
+            verification_coding=verification_status_coding[verification],
+            verification=verification,
+            name=name,
+            subject="/".join(
+                [
+                    Patient.api_path,
+                    not_none(get_target_id_from_record(Patient, record)),
+                ]
+            ),
+        )
 
         # code
         if ontology_uri and ontology_code:
@@ -130,37 +180,11 @@ class Phenotype:
 
         # onsetDateTime
         try:
-            entity["onsetDateTime"] = {
-                "extension": [
-                    {
-                        "extension": [
-                            {
-                                "url": "event",
-                                "valueCodeableConcept": {
-                                    "coding": [
-                                        {
-                                            "system": "http://snomed.info/sct",
-                                            "code": "3950001",
-                                            "display": "Birth",
-                                        }
-                                    ]
-                                },
-                            },
-                            {"url": "relationship", "valueCode": "after"},
-                            {
-                                "url": "offset",
-                                "valueDuration": {
-                                    "value": int(event_age_value),
-                                    "unit": age_units_to_unit[event_age_units],
-                                    "system": "http://unitsofmeasure.org",
-                                    "code": age_units_to_code[event_age_units],
-                                },
-                            },
-                        ],
-                        "url": "http://hl7.org/fhir/StructureDefinition/relative-date",
-                    }
-                ]
-            }
+            entity["onsetDateTime"] = cls.onset_template.render(
+                value=int(event_age_value),
+                unit=age_units_to_unit[event_age_units],
+                code=age_units_to_code[event_age_units],
+            )
         except:
             pass
 
@@ -5,7 +5,8 @@ from rows of tabular practitioner metadata.
 from abc import abstractmethod
 
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.utils import identifier_key_components, not_none
 
 
 class Practitioner:
@@ -18,9 +19,13 @@ class Practitioner:
     def get_key_components(cls, record, get_target_id_from_record):
         return {"identifier": not_none(record["PRACTITIONER|NAME"])}
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return resolve_target_ids(host, cls.api_path, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -6,7 +6,8 @@ from abc import abstractmethod
 
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import ResearchStudy, Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.utils import not_none
 
 # http://hl7.org/fhir/ValueSet/research-subject-status
 status = "off-study"
@@ -27,9 +28,16 @@ class ResearchSubject:
             "individual": f"{Patient.api_path}/{patient_id}",
         }
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return {
+            "study": not_none(body["study"]["reference"]),
+            "individual": not_none(body["individual"]["reference"]),
+        }
+
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return resolve_target_ids(host, cls.api_path, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -7,7 +7,9 @@ from abc import abstractmethod
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from target_api_plugins.entity_builders import Patient
-from target_api_plugins.utils import not_none, drop_none, yield_resource_ids
+from target_api_plugins.id_resolution import resolve_target_ids
+from target_api_plugins.templates import Slot, Template
+from target_api_plugins.utils import identifier_key_components, not_none
 
 # http://hl7.org/fhir/ValueSet/specimen-status
 status_code = "unavailable"
@@ -33,13 +35,65 @@ class Specimen:
     target_id_concept = None
     service_id_fields = None
 
+    template = Template(
+        {
+            "resourceType": api_path,
+            "id": Slot("id"),
+            "meta": {
+                "profile": [f"http://hl7.org/fhir/StructureDefinition/{api_path}"],
+                "tag": [{"code": Slot("study_id")}],
+            },
+            "identifier": [{"value": Slot("identifier")}],
+            "status": status_code,
+            "subject": {"reference": Slot("subject")},
+        }
+    )
+
+    collected_template = Template(
+        {
+            "extension": [
+                {
+                    "extension": [
+                        {
+                            "url": "event",
+                            "valueCodeableConcept": {
+                                "coding": [
+                                    {
+                                        "system": "http://snomed.info/sct",
+                                        "code": "3950001",
+                                        "display": "Birth",
+                                    }
+                                ]
+                            },
+                        },
+                        {"url": "relationship", "valueCode": "after"},
+                        {
+                            "url": "offset",
+                            "valueDuration": {
+                                "value": Slot("value"),
+                                "unit": Slot("unit"),
+                                "system": "http://unitsofmeasure.org",
+                                "code": Slot("code"),
+                            },
+                        },
+                    ],
+                    "url": "http://hl7.org/fhir/StructureDefinition/relative-date",
+                }
+            ]
+        }
+    )
+
     @classmethod
     def get_key_components(cls, record, get_target_id_from_record):
         return {"identifier": not_none(record[CONCEPT.BIOSPECIMEN.ID])}
 
+    @classmethod
+    def get_key_components_from_body(cls, body):
+        return identifier_key_components(body)
+
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return resolve_target_ids(host, cls.api_path, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -55,24 +109,17 @@ class Specimen:
         body_site_ontology_uri = record.get("BIOSPECIMEN|BODY_SITE|ONTOLOGY_URI")
         body_site_ontology_code = record.get("BIOSPECIMEN|BODY_SITE|ONTOLOGY_CODE")
 
-        entity = {
-            "resourceType": cls.api_path,
-            "id": get_target_id_from_record(cls, record),
-            "meta": {
-                "profile": [f"http://hl7.org/fhir/StructureDefinition/{cls.api_path}"],
-                "tag": [{"code": study_id}],
-            },
-            "identifier": [{"value": biospecimen_id}],
-            "status": status_code,
-            "subject": {
-                "reference": "/".join(
-                    [
-                        Patient.api_path,
-                        not_none(get_target_id_from_record(Patient, record)),
-                    ]
-                )
-            },
-        }
+        entity = cls.template.render(
+            id=get_target_id_from_record(cls, record),
+            study_id=study_id,
+            identifier=biospecimen_id,
+            subject="/".join(
+                [
+                    Patient.api_path,
+                    not_none(get_target_id_from_record(Patient, record)),
+                ]
+            ),
+        )
 
         # type
         specimen_type = {}
@@ -93,37 +140,11 @@ class Specimen:
 
         # collectedDateTime
         try:
-            collection["_collectedDateTime"] = {
-                "extension": [
-                    {
-                        "extension": [
-                            {
-                                "url": "event",
-                                "valueCodeableConcept": {
-                                    "coding": [
-                                        {
-                                            "system": "http://snomed.info/sct",
-                                            "code": "3950001",
-                                            "display": "Birth",
-                                        }
-                                    ]
-                                },
-                            },
-                            {"url": "relationship", "valueCode": "after"},
-                            {
-                                "url": "offset",
-                                "valueDuration": {
-                                    "value": int(event_age_value),
-                                    "unit": age_units_to_unit[event_age_units],
-                                    "system": "http://unitsofmeasure.org",
-                                    "code": age_units_to_code[event_age_units],
-                                },
-                            },
-                        ],
-                        "url": "http://hl7.org/fhir/StructureDefinition/relative-date",
-                    }
-                ]
-            }
+            collection["_collectedDateTime"] = cls.collected_template.render(
+                value=int(event_age_value),
+                unit=age_units_to_unit[event_age_units],
+                code=age_units_to_code[event_age_units],
+            )
         except:
             pass
 
@@ -0,0 +1,631 @@
+"""
+A local, in-memory stand-in for the FHIR service, implementing the subset of
+the FHIR REST API (https://www.hl7.org/fhir/http.html) that this loader uses,
+with configurable latency, page size, and throttling. Use it to measure load
+performance offline and reproducibly.
+
+Run it with:
+
+    python -m target_api_plugins.fhir_standin --port 8000 \\
+        [--latency 0.05] [--jitter 0.01] [--page_size 20] \\
+        [--throttle_rate 0.01] [--max_in_flight 50]
+
+or start it from Python:
+
+    with FhirStandin(latency=0.05) as server:
+        ...  # load into server.url
+
+Supported interactions: read, create (POST), update (PUT by ID),
+conditional update (PUT by search), JSON Patch (PATCH by ID, with add,
+remove, replace and test operations and If-Match version checks),
+batch/transaction Bundles POSTed to the base (transactions all or none),
+and searches on _id, _tag, identifier (comma-separated OR values) and
+reference parameters (e.g. study, individual), with _count, _offset,
+_elements and _summary=count.
+Search results are paged with next links and report the total.
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# Splits a search value on commas that aren't escaped with a backslash
+_unescaped_comma = re.compile(r"(?<!\\),")
+
+# Search parameters that control the result set rather than filter it
+_result_params = {"_count", "_offset", "_elements", "_summary", "_format"}
+
+
+def _unescape(value):
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def _or_values(value):
+    return [_unescape(v) for v in _unescaped_comma.split(value)]
+
+
+def _subsetted(resource):
+    """Marks a resource as partially returned, like FHIR servers do."""
+    meta = dict(resource.get("meta", {}))
+    meta["tag"] = meta.get("tag", []) + [
+        {
+            "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationValue",
+            "code": "SUBSETTED",
+        }
+    ]
+    return dict(resource, meta=meta)
+
+
+def _apply_patch(resource, operations):
+    """Applies JSON Patch (RFC 6902) add, remove, replace and test
+    operations to a resource in place, raising ValueError, KeyError,
+    IndexError or TypeError if one can't be applied.
+    """
+    for operation in operations:
+        op = operation["op"]
+        if op not in {"add", "remove", "replace", "test"}:
+            raise ValueError(f"Unsupported patch operation {op!r}")
+        *parents, last = [
+            p.replace("~1", "/").replace("~0", "~")
+            for p in operation["path"].split("/")[1:]
+        ]
+        target = resource
+        for part in parents:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+
+        if isinstance(target, list):
+            index = len(target) if last == "-" and op == "add" else int(last)
+            if op == "add":
+                if index > len(target):
+                    raise IndexError(f"{operation['path']} is out of range")
+                target.insert(index, operation["value"])
+                continue
+            current = target[index]
+        else:
+            if op == "add":
+                target[last] = operation["value"]
+                continue
+            current = target[last]
+
+        if op == "remove":
+            del target[index if isinstance(target, list) else last]
+        elif op == "replace":
+            target[index if isinstance(target, list) else last] = operation["value"]
+        elif current != operation["value"]:
+            raise ValueError(f"Test of {operation['path']} failed")
+
+
+class _Rollback(Exception):
+    """Aborts a transaction Bundle with the answer to its failed entry."""
+
+    def __init__(self, answer):
+        super().__init__(answer[0])
+        self.answer = answer
+
+
+class ResourceStore:
+    """Thread-safe in-memory store of FHIR resources by type and ID."""
+
+    def __init__(self):
+        self._resources = {}
+        self._lock = threading.RLock()
+
+    def get(self, resource_type, resource_id):
+        with self._lock:
+            return self._resources.get(resource_type, {}).get(resource_id)
+
+    def put(self, resource_type, resource_id, resource):
+        """Stores a resource, returning True if it was newly created."""
+        with self._lock:
+            resources = self._resources.setdefault(resource_type, {})
+            created = resource_id not in resources
+            resource = dict(resource, resourceType=resource_type, id=resource_id)
+            previous = resources.get(resource_id, {})
+            version = int(previous.get("meta", {}).get("versionId", 0)) + 1
+            resource["meta"] = dict(resource.get("meta", {}), versionId=str(version))
+            resources[resource_id] = resource
+            return created
+
+    @contextmanager
+    def transaction(self):
+        """Makes the writes within it all or none: if it exits with an
+        exception, the stored resources are restored to how they were when it
+        started. Other threads wait for it to end.
+        """
+        with self._lock:
+            saved = {
+                resource_type: dict(resources)
+                for resource_type, resources in self._resources.items()
+            }
+            try:
+                yield
+            except BaseException:
+                self._resources = saved
+                raise
+
+    def patch(self, resource_type, resource_id, operations, version=None):
+        """Applies JSON Patch operations to a stored resource, all or none.
+
+        :param version: If given, the versionId the resource must still have
+        :type version: str
+        :return: an HTTP status and, on failure, why
+        :rtype: tuple
+        """
+        with self._lock:
+            resource = self.get(resource_type, resource_id)
+            if resource is None:
+                return 404, f"{resource_type}/{resource_id} not found"
+            if version is not None and resource["meta"]["versionId"] != version:
+                return 412, (
+                    f"{resource_type}/{resource_id} is at version "
+                    f"{resource['meta']['versionId']}, not {version}"
+                )
+            patched = deepcopy(resource)
+            try:
+                _apply_patch(patched, operations)
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                return 422, f"Can not apply patch: {e!r}"
+            self.put(resource_type, resource_id, patched)
+            return 200, None
+
+    def search(self, resource_type, params):
+        """Finds the resources of a type matching every search parameter.
+
+        :param params: (name, value) pairs, AND-ed together
+        :type params: list
+        :return: matching resources, in insertion order
+        :rtype: list
+        """
+        with self._lock:
+            resources = list(self._resources.get(resource_type, {}).values())
+        for name, value in params:
+            if name in _result_params:
+                continue
+            resources = [r for r in resources if self._matches(r, name, value)]
+        return resources
+
+    @staticmethod
+    def _matches(resource, name, value):
+        values = _or_values(value)
+        if name == "_id":
+            return resource["id"] in values
+        if name == "_tag":
+            codes = {t.get("code") for t in resource.get("meta", {}).get("tag", [])}
+            return any(v.split("|")[-1] in codes for v in values)
+        if name == "identifier":
+            found = {i.get("value") for i in resource.get("identifier", [])}
+            return any(v.split("|")[-1] in found for v in values)
+
+        field = resource.get(name)
+        if isinstance(field, dict):
+            return field.get("reference") in values
+        return field in values
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one segment, so responses aren't held up by
+    # Nagle's algorithm and delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def standin(self):
+        return self.server.standin
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        parts = urlsplit(self.path)
+        segments = [s for s in parts.path.split("/") if s]
+        return segments, parse_qsl(parts.query, keep_blank_values=True)
+
+    def _handle(self, method):
+        standin = self.standin
+        with standin._in_flight_lock:
+            standin.in_flight += 1
+            standin.requests += 1
+            in_flight = standin.in_flight
+        try:
+            body = self._read_json() if method in {"POST", "PUT", "PATCH"} else None
+            standin.sleep()
+            if standin.should_throttle(in_flight):
+                self.send_response(random.choice([429, 503]))
+                self.send_header("Retry-After", str(standin.retry_after))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status, resource, headers = standin.dispatch(
+                method, *self._route(), body, self._base_url(), self.headers
+            )
+            if (
+                resource is not None
+                and self.headers.get("Prefer", "") == "return=minimal"
+                and method in {"POST", "PUT", "PATCH"}
+            ):
+                if resource.get("resourceType") == "Bundle":
+                    resource = dict(
+                        resource,
+                        entry=[
+                            {k: v for k, v in e.items() if k != "resource"}
+                            for e in resource.get("entry", [])
+                        ],
+                    )
+                else:
+                    resource = None
+            self._send(status, resource, headers)
+        finally:
+            with standin._in_flight_lock:
+                standin.in_flight -= 1
+
+    def _base_url(self):
+        return f"http://{self.headers.get('Host', 'localhost')}"
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading a streamed response drop the connection
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FhirStandin:
+    """Serves an in-memory FHIR store over HTTP on localhost."""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        page_size=20,
+        max_page_size=1000,
+        throttle_rate=0.0,
+        max_in_flight=None,
+        retry_after=1,
+        allow_client_ids=True,
+    ):
+        """
+        :param host: Interface to listen on
+        :type host: str
+        :param port: Port to listen on (0 picks a free port)
+        :type port: int
+        :param latency: Seconds added to every request
+        :type latency: float
+        :param jitter: Random extra seconds, up to this much, per request
+        :type jitter: float
+        :param page_size: Search results per page when _count isn't given
+        :type page_size: int
+        :param max_page_size: Largest _count honored
+        :type max_page_size: int
+        :param throttle_rate: Fraction of requests answered with 429 or 503
+        :type throttle_rate: float
+        :param max_in_flight: Answer 429 or 503 when more requests than this
+            are being served at once
+        :type max_in_flight: int
+        :param retry_after: Retry-After seconds sent with 429/503 answers
+        :type retry_after: int
+        :param allow_client_ids: Whether PUT may create a resource with an ID
+            chosen by the client
+        :type allow_client_ids: bool
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.throttle_rate = throttle_rate
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.allow_client_ids = allow_client_ids
+        self.store = ResourceStore()
+        self.in_flight = 0
+        self.requests = 0
+        self._in_flight_lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serves requests in a background thread."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fhir-standin", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def sleep(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_throttle(self, in_flight):
+        if self.max_in_flight is not None and in_flight > self.max_in_flight:
+            return True
+        return random.random() < self.throttle_rate
+
+    def dispatch(self, method, segments, params, body, base_url, headers=None):
+        """Handles one interaction.
+
+        :param headers: Request headers, for PATCH's Content-Type and If-Match
+        :type headers: Mapping
+        :return: (status, response body, response headers)
+        :rtype: tuple
+        """
+        headers = headers or {}
+        if method == "POST" and not segments:
+            return self.bundle(body, base_url)
+        if not segments or len(segments) > 2:
+            return self._error(404, f"Unknown path /{'/'.join(segments)}")
+
+        resource_type = segments[0]
+        resource_id = segments[1] if len(segments) == 2 else None
+
+        if method == "GET" and resource_id:
+            resource = self.store.get(resource_type, resource_id)
+            if resource is None:
+                return self._error(404, f"{resource_type}/{resource_id} not found")
+            return 200, resource, {"ETag": f'W/"{resource["meta"]["versionId"]}"'}
+        if method == "GET":
+            return self.search(resource_type, params, base_url)
+        if method == "POST":
+            return self.write(resource_type, uuid.uuid4().hex, body)
+        if method == "PUT" and resource_id:
+            if (
+                not self.allow_client_ids
+                and self.store.get(resource_type, resource_id) is None
+            ):
+                return self._error(
+                    400,
+                    f"Can not update {resource_type}/{resource_id}, "
+                    "no resource with this ID exists and clients may not "
+                    "assign IDs",
+                )
+            return self.write(resource_type, resource_id, body)
+        if method == "PUT":
+            matches = self.store.search(resource_type, params)
+            if len(matches) > 1:
+                return self._error(
+                    412, f"Conditional update matched {len(matches)} resources"
+                )
+            target_id = matches[0]["id"] if matches else uuid.uuid4().hex
+            return self.write(resource_type, target_id, body)
+        if method == "PATCH" and resource_id:
+            return self.patch(resource_type, resource_id, body, headers)
+        return self._error(405, f"{method} is not supported")
+
+    def write(self, resource_type, resource_id, body):
+        created = self.store.put(resource_type, resource_id, body or {})
+        resource = self.store.get(resource_type, resource_id)
+        return (201 if created else 200), resource, self._version_headers(resource)
+
+    def patch(self, resource_type, resource_id, operations, headers):
+        content_type = headers.get("Content-Type", "")
+        if not content_type.startswith("application/json-patch+json"):
+            return self._error(415, f"Can not PATCH with {content_type!r}")
+        if not isinstance(operations, list):
+            return self._error(400, "A JSON Patch must be a list of operations")
+        match = re.fullmatch(r'(?:W/)?"([^"]*)"', headers.get("If-Match") or "")
+        status, diagnostics = self.store.patch(
+            resource_type,
+            resource_id,
+            operations,
+            version=match.group(1) if match else None,
+        )
+        if diagnostics:
+            return self._error(status, diagnostics)
+        resource = self.store.get(resource_type, resource_id)
+        return 200, resource, self._version_headers(resource)
+
+    @staticmethod
+    def _version_headers(resource):
+        version = resource["meta"]["versionId"]
+        return {
+            "Location": f"{resource['resourceType']}/{resource['id']}/_history/{version}",
+            "ETag": f'W/"{version}"',
+        }
+
+    def search(self, resource_type, params, base_url):
+        values = dict(params)
+        matches = self.store.search(resource_type, params)
+        bundle = {"resourceType": "Bundle", "type": "searchset", "total": len(matches)}
+        if values.get("_summary") == "count":
+            return 200, bundle, {}
+
+        count = min(int(values.get("_count", self.page_size)), self.max_page_size)
+        offset = int(values.get("_offset", 0))
+        page = matches[offset : offset + count]
+
+        elements = values.get("_elements")
+        if elements:
+            keep = {"resourceType", "id", "meta"} | set(elements.split(","))
+            page = [_subsetted({k: v for k, v in r.items() if k in keep}) for r in page]
+        else:
+            page = [deepcopy(r) for r in page]
+
+        bundle["entry"] = [
+            {"fullUrl": f"{base_url}/{resource_type}/{r['id']}", "resource": r}
+            for r in page
+        ]
+        filters = list(dict.fromkeys(p for p in params if p[0] != "_offset"))
+        links = [
+            {
+                "relation": "self",
+                "url": f"{base_url}/{resource_type}?{urlencode(params)}",
+            }
+        ]
+        if offset + count < len(matches):
+            next_params = filters + [("_offset", offset + count)]
+            if "_count" not in values:
+                next_params.append(("_count", count))
+            links.append(
+                {
+                    "relation": "next",
+                    "url": f"{base_url}/{resource_type}?{urlencode(next_params)}",
+                }
+            )
+        bundle["link"] = links
+        return 200, bundle, {}
+
+    def bundle(self, body, base_url):
+        """Processes a batch or transaction Bundle. A transaction's entries
+        are applied all or none: if one fails, the writes of the others are
+        rolled back and the failure is the answer.
+        """
+        bundle_type = (body or {}).get("type")
+        if bundle_type not in {"batch", "transaction"}:
+            return self._error(400, "Only batch and transaction Bundles are supported")
+        if bundle_type == "batch":
+            return self._bundle_entries(body, base_url, bundle_type)
+
+        try:
+            with self.store.transaction():
+                return self._bundle_entries(body, base_url, bundle_type)
+        except _Rollback as e:
+            return e.answer
+
+    def _bundle_entries(self, body, base_url, bundle_type):
+        entries = []
+        for entry in body.get("entry", []):
+            request = entry.get("request", {})
+            parts = urlsplit(request.get("url", ""))
+            segments = [s for s in parts.path.split("/") if s]
+            status, resource, headers = self.dispatch(
+                request.get("method", ""),
+                segments,
+                parse_qsl(parts.query, keep_blank_values=True),
+                entry.get("resource"),
+                base_url,
+            )
+            response = {"status": str(status)}
+            if "Location" in headers:
+                response["location"] = headers["Location"]
+            if status >= 400:
+                if bundle_type == "transaction":
+                    raise _Rollback((status, resource, {}))
+                response["outcome"] = resource
+                entries.append({"response": response})
+            else:
+                entries.append({"resource": resource, "response": response})
+
+        return (
+            200,
+            {
+                "resourceType": "Bundle",
+                "type": f"{bundle_type}-response",
+                "entry": entries,
+            },
+            {},
+        )
+
+    @staticmethod
+    def _error(status, diagnostics):
+        return (
+            status,
+            {
+                "resourceType": "OperationOutcome",
+                "issue": [
+                    {
+                        "severity": "error",
+                        "code": "processing",
+                        "diagnostics": diagnostics,
+                    }
+                ],
+            },
+            {},
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve an in-memory FHIR stand-in for load testing."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--page_size", type=int, default=20)
+    parser.add_argument("--throttle_rate", type=float, default=0.0)
+    parser.add_argument("--max_in_flight", type=int, default=None)
+    parser.add_argument("--retry_after", type=int, default=1)
+    parser.add_argument(
+        "--no_client_ids",
+        action="store_true",
+        help="Refuse PUTs that would create a resource with a client-chosen ID",
+    )
+    args = parser.parse_args(argv)
+
+    standin = FhirStandin(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        page_size=args.page_size,
+        throttle_rate=args.throttle_rate,
+        max_in_flight=args.max_in_flight,
+        retry_after=args.retry_after,
+        allow_client_ids=not args.no_client_ids,
+    )
+    print(f"FHIR stand-in serving at {standin.url}")
+    try:
+        standin.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Keeps resolved FHIR resource IDs in a local SQLite database so that repeat
+ingests don't have to look them up on the server again.
+
+Invalidate entries from the command line with:
+
+    python -m target_api_plugins.id_cache invalidate CACHE_PATH \\
+        --target_url URL [--study STUDY_ID] [--resource_type TYPE]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+from target_api_plugins.utils import drop_none
+
+# meta.tag code that marks a resource as only partially returned
+SUBSETTED = "SUBSETTED"
+
+
+def canonical_key(key_components):
+    """Turns an entity's key components into a stable string."""
+    return json.dumps(drop_none(key_components), sort_keys=True)
+
+
+def study_tag(resource):
+    """Returns the first meta.tag code of a FHIR resource, if any, ignoring
+    the SUBSETTED tag that servers add to _elements/_summary results.
+    """
+    for tag in resource.get("meta", {}).get("tag", []):
+        if tag.get("code") and tag["code"] != SUBSETTED:
+            return tag["code"]
+    return None
+
+
+class TargetIdCache:
+    """Maps (target URL, resource type, key components) to resource IDs."""
+
+    def __init__(self, path):
+        """
+        :param path: Path of the SQLite database file, created if missing
+        :type path: str
+        """
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS target_ids ("
+                " host TEXT NOT NULL,"
+                " api_path TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " tag TEXT,"
+                " resource_id TEXT NOT NULL,"
+                " PRIMARY KEY (host, api_path, key))"
+            )
+
+    def get(self, host, api_path, key_components):
+        """Looks up a cached resource ID.
+
+        :return: the cached ID, or None if the key isn't cached
+        :rtype: str
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT resource_id FROM target_ids"
+                " WHERE host = ? AND api_path = ? AND key = ?",
+                (host.rstrip("/"), api_path, canonical_key(key_components)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, host, api_path, key_components, resource_id, tag=None):
+        """Caches the resource ID for an entity's key components."""
+        self.put_many(host, api_path, [(key_components, resource_id, tag)])
+
+    def put_many(self, host, api_path, rows):
+        """Caches many (key_components, resource_id, tag) triples at once."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO target_ids"
+                " (host, api_path, key, tag, resource_id) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        host.rstrip("/"),
+                        api_path,
+                        canonical_key(key_components),
+                        tag,
+                        resource_id,
+                    )
+                    for key_components, resource_id, tag in rows
+                ],
+            )
+
+    def remember_resource(self, host, api_path, body, resource_id):
+        """Caches a submitted resource under each of its identifier values,
+        both with and without its study tag, matching the key components the
+        builders search by.
+        """
+        tag = study_tag(body)
+        rows = []
+        for identifier in body.get("identifier", []):
+            value = identifier.get("value")
+            if not value:
+                continue
+            rows.append(({"identifier": value}, resource_id, tag))
+            if tag:
+                rows.append(({"_tag": tag, "identifier": value}, resource_id, tag))
+        if rows:
+            self.put_many(host, api_path, rows)
+
+    def forget_id(self, host, api_path, resource_id):
+        """Drops every key cached as resolving to resource_id, e.g. after the
+        server said it has no resource with that ID.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM target_ids"
+                " WHERE host = ? AND api_path = ? AND resource_id = ?",
+                (host.rstrip("/"), api_path, resource_id),
+            )
+
+    def invalidate(self, host, study=None, api_path=None):
+        """Drops cached IDs for a target URL, optionally only those of one
+        study and/or one resource type.
+
+        :return: number of entries dropped
+        :rtype: int
+        """
+        query = "DELETE FROM target_ids WHERE host = ?"
+        params = [host.rstrip("/")]
+        if study is not None:
+            query += " AND tag = ?"
+            params.append(study)
+        if api_path is not None:
+            query += " AND api_path = ?"
+            params.append(api_path)
+        with self._lock, self._conn:
+            return self._conn.execute(query, params).rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the FHIR target ID cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    invalidate = subparsers.add_parser(
+        "invalidate", help="Drop cached IDs for a target URL."
+    )
+    invalidate.add_argument("cache_path", help="Path of the SQLite cache file")
+    invalidate.add_argument("--target_url", required=True)
+    invalidate.add_argument("--study", help="Only drop IDs tagged with this study")
+    invalidate.add_argument(
+        "--resource_type", help="Only drop IDs of this resource type"
+    )
+    args = parser.parse_args(argv)
+
+    dropped = TargetIdCache(args.cache_path).invalidate(
+        args.target_url, study=args.study, api_path=args.resource_type
+    )
+    print(f"Dropped {dropped} cached IDs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,465 @@
+"""
+Resolves entity key components to FHIR resource IDs for the builders'
+query_target_ids.
+"""
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import Future
+
+from requests import RequestException
+
+from target_api_plugins.id_cache import TargetIdCache, canonical_key, study_tag
+from target_api_plugins.utils import (
+    FHIR_SEARCH_PAGE_SIZE,
+    count_resources,
+    drop_none,
+    escape_filters,
+    escape_search_value,
+    resolve_identifiers,
+    yield_resources,
+)
+
+logger = logging.getLogger(__name__)
+
+# Studies (meta.tag codes) whose resources are prefetched into an in-memory
+# identifier index instead of being searched for one record at a time
+FHIR_PREFETCH_TAGS = {
+    tag.strip() for tag in os.getenv("FHIR_PREFETCH_TAGS", "").split(",") if tag.strip()
+}
+
+# SQLite file that keeps resolved resource IDs across runs
+FHIR_ID_CACHE = os.getenv("FHIR_ID_CACHE")
+
+# How resource IDs are assigned: "server" (looked up, or minted by the server
+# on POST) or "deterministic" (derived from each entity's key components)
+FHIR_ID_STRATEGY = os.getenv("FHIR_ID_STRATEGY", "server").lower()
+ID_STRATEGIES = {"server", "deterministic"}
+if FHIR_ID_STRATEGY not in ID_STRATEGIES:
+    raise ValueError(
+        f"FHIR_ID_STRATEGY must be one of {sorted(ID_STRATEGIES)}, "
+        f"not {FHIR_ID_STRATEGY!r}"
+    )
+
+# Whether identifier keys that weren't found, and resource types that have
+# no resources for a study yet, are remembered for the rest of the run
+FHIR_NEGATIVE_CACHE = os.getenv("FHIR_NEGATIVE_CACHE", "false").lower() == "true"
+
+# Namespace of the UUIDv5 resource IDs minted by deterministic_id
+ID_NAMESPACE = uuid.uuid5(
+    uuid.NAMESPACE_URL, "https://github.com/kids-first/clovoc-app-fhir-ingest"
+)
+
+
+class IdentifierIndex:
+    """Maps identifier values to resource IDs for every resource of a type
+    tagged with a study, built by paging once through a _tag search.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def prefetch(self, host, api_path, tag):
+        """Pages through all resources of a type tagged with a study and
+        indexes them by identifier value. Only the first call for a given
+        host, type, and tag goes to the server.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param api_path: A FHIR resource type (e.g. "Patient")
+        :type api_path: str
+        :param tag: A meta.tag code (e.g. "phs001442")
+        :type tag: str
+        :return: map from identifier value to list of resource IDs
+        :rtype: dict
+        """
+        key = (host, api_path, tag)
+        if key in self._index:
+            return self._index[key]
+
+        with self._key_lock(key):
+            if key not in self._index:
+                index = {}
+                for entry in yield_resources(
+                    host,
+                    api_path,
+                    {"_tag": escape_search_value(tag)},
+                    count=FHIR_SEARCH_PAGE_SIZE,
+                    elements=["identifier"],
+                ):
+                    resource = entry["resource"]
+                    for identifier in resource.get("identifier", []):
+                        ids = index.setdefault(identifier.get("value"), [])
+                        if resource["id"] not in ids:
+                            ids.append(resource["id"])
+                self._index[key] = index
+        return self._index[key]
+
+    def lookup(self, host, api_path, identifier, tags):
+        """Finds the resources with an identifier value among the resources
+        tagged with any of the given studies.
+
+        :return: (resource ID, study tag) pairs
+        :rtype: list
+        """
+        found = []
+        seen = set()
+        for tag in sorted(tags):
+            for resource_id in self.prefetch(host, api_path, tag).get(identifier, []):
+                if resource_id not in seen:
+                    seen.add(resource_id)
+                    found.append((resource_id, tag))
+        return found
+
+
+class MissCache:
+    """Remembers, for one run, the identifier keys that searches didn't find
+    and the resource types (per study tag) that had no resources at all when
+    first looked up. Resources submitted during the run are recorded as they
+    are created, so that answers stay right as the load fills the server.
+
+    Keys with a _tag are checked against that study's resources. Most keys
+    (e.g. those of Observations) have none, so they are checked against the
+    studies of the resources loaded so far, as those are the studies the
+    load's records belong to.
+
+    Assumes this process is the only one writing those resources during the
+    run.
+    """
+
+    def __init__(self):
+        # (host, api_path, canonical key) of keys known not to exist
+        self._missing = set()
+        # (host, api_path, tag) -> future of whether the server had no such
+        # resources
+        self._empty = {}
+        # (host, api_path, identifier value) -> (resource ID, tag) pairs
+        # submitted during this run
+        self._created = {}
+        # host -> study tags of the keys and resources loaded during this run
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def _is_empty(self, host, api_path, tag):
+        key = (host, api_path, tag)
+        with self._lock:
+            empty = self._empty.get(key)
+            probe = empty is None
+            if probe:
+                empty = self._empty[key] = Future()
+
+        # Other threads' lookups wait for this probe only, not on the lock
+        if probe:
+            try:
+                total = count_resources(
+                    host,
+                    api_path,
+                    {"_tag": escape_search_value(tag)} if tag else {},
+                )
+            except RequestException as e:
+                logger.warning(f"Could not count {api_path} resources: {e}")
+                total = None
+            empty.set_result(total == 0)
+        return empty.result()
+
+    def _study_tags(self, host, key_components):
+        tag = key_components.get("_tag")
+        with self._lock:
+            if tag:
+                self._tags.setdefault(host, set()).add(tag)
+                return {tag}
+            return set(self._tags.get(host, ()))
+
+    def lookup(self, host, api_path, key_components):
+        """Answers an identifier key lookup without searching, if possible.
+
+        :return: (resource ID, study tag) pairs, or None if a search is
+            needed
+        :rtype: list
+        """
+        if (host, api_path, canonical_key(key_components)) in self._missing:
+            return []
+        tags = self._study_tags(host, key_components)
+        if all(self._is_empty(host, api_path, tag) for tag in sorted(tags or [None])):
+            return [
+                (resource_id, created_tag)
+                for resource_id, created_tag in self._created.get(
+                    (host, api_path, key_components["identifier"]), []
+                )
+                if not tags or created_tag in tags
+            ]
+        return None
+
+    def missed(self, host, api_path, key_components):
+        """Records that a search found nothing for a key."""
+        self._missing.add((host, api_path, canonical_key(key_components)))
+
+    def remember(self, host, api_path, body, resource_id):
+        """Records a resource submitted during this run."""
+        tag = study_tag(body)
+        with self._lock:
+            if tag:
+                self._tags.setdefault(host, set()).add(tag)
+            for identifier in body.get("identifier", []):
+                value = identifier.get("value")
+                created = self._created.setdefault((host, api_path, value), [])
+                if (resource_id, tag) not in created:
+                    created.append((resource_id, tag))
+                for key_components in [
+                    {"identifier": value},
+                    {"identifier": value, "_tag": tag},
+                ]:
+                    self._missing.discard(
+                        (host, api_path, canonical_key(key_components))
+                    )
+
+
+identifier_index = IdentifierIndex()
+id_cache = TargetIdCache(FHIR_ID_CACHE) if FHIR_ID_CACHE else None
+miss_cache = MissCache() if FHIR_NEGATIVE_CACHE else None
+
+# Resource types whose IDs are resolved by the server at submit time
+_unsearched_types = set()
+
+# Whether IDs are only ever derived locally, e.g. when exporting
+_offline = False
+
+# (host, api_path, canonical key) -> (resource ID, study tag) pairs found by
+# warm_target_ids during this run
+_warmed = {}
+
+
+def skip_target_id_searches(api_path="*"):
+    """Stops searching the server for the IDs of a resource type, or of all
+    types if none is given.
+
+    Conditional updates match resources by their key on the server, so once
+    a resource type is being submitted that way, searching for its IDs
+    beforehand only costs a round trip. The local ID cache and prefetched
+    index are still consulted.
+    """
+    _unsearched_types.add(api_path)
+
+
+def skip_target_id_lookups():
+    """Stops looking up resource IDs anywhere but in the key components:
+    resolve_target_ids then returns deterministic IDs, or no IDs at all.
+    Exports use this, since the IDs they reference must not come from a
+    server (or an ID cache filled from one), and they never talk to a server.
+    """
+    global _offline
+    _offline = True
+
+
+def deterministic_id(api_path, key_components):
+    """Derives a stable FHIR logical ID from an entity's key components, so
+    the same entity gets the same ID on every run without a lookup.
+
+    :param api_path: A FHIR resource type (e.g. "Patient")
+    :type api_path: str
+    :param key_components: search parameters identifying the entity
+    :type key_components: dict
+    :return: a UUIDv5 string
+    :rtype: str
+    """
+    return str(uuid.uuid5(ID_NAMESPACE, f"{api_path}|{canonical_key(key_components)}"))
+
+
+def _is_identifier_key(key_components):
+    return bool(key_components.get("identifier")) and set(key_components) <= {
+        "identifier",
+        "_tag",
+    }
+
+
+def _prefetched(key_components):
+    tag = key_components.get("_tag")
+    return (
+        FHIR_PREFETCH_TAGS
+        and _is_identifier_key(key_components)
+        and (tag is None or tag in FHIR_PREFETCH_TAGS)
+    )
+
+
+def _searched(api_path):
+    return api_path not in _unsearched_types and "*" not in _unsearched_types
+
+
+def warm_target_ids(host, api_path, key_components_list):
+    """Resolves many keys of one resource type ahead of their lookups, with
+    one comma-separated (OR) identifier search per URL-sized chunk of keys
+    instead of one search per key. Later resolve_target_ids calls for these
+    keys are answered from the results.
+
+    Keys that the ID cache or the prefetched identifier index can answer are
+    left to them, and nothing is searched for with deterministic IDs.
+
+    The ingest loader resolves keys record by record and doesn't call this;
+    callers that drive a load themselves call it before loading a type, e.g.
+    with the get_key_components of every record of an entity class.
+
+    :param host: A FHIR service base URL
+    :type host: str
+    :param api_path: A FHIR resource type (e.g. "Patient")
+    :type api_path: str
+    :param key_components_list: search parameters identifying each entity
+    :type key_components_list: list of dicts
+    """
+    if FHIR_ID_STRATEGY == "deterministic" or _offline or not _searched(api_path):
+        return
+
+    todo = {}
+    for key_components in key_components_list:
+        key_components = drop_none(key_components)
+        key = (host, api_path, canonical_key(key_components))
+        if (
+            key in _warmed
+            or key[2] in todo
+            or _prefetched(key_components)
+            or (id_cache is not None and id_cache.get(host, api_path, key_components))
+        ):
+            continue
+        todo[key[2]] = key_components
+
+    keys = list(todo.values())
+    rows = []
+    for key_components, matches in zip(keys, resolve_identifiers(host, api_path, keys)):
+        found = [
+            (resource_id, study_tag(resource)) for resource_id, resource in matches
+        ]
+        _warmed[(host, api_path, canonical_key(key_components))] = found
+        if len(found) == 1:
+            rows.append((key_components,) + found[0])
+
+    if id_cache is not None and rows:
+        id_cache.put_many(host, api_path, rows)
+
+
+def resolve_target_ids(host, api_path, key_components):
+    """Finds the IDs of the resources matching an entity's key components.
+
+    With FHIR_ID_STRATEGY=deterministic the ID is derived from the key
+    components and nothing is looked up, and after skip_target_id_lookups
+    nothing is found. Otherwise lookups are answered, in
+    order, from:
+
+    1. The on-disk ID cache, when FHIR_ID_CACHE names a cache file
+    2. Keys resolved ahead of time by warm_target_ids
+    3. The prefetched identifier index, for identifier keys of the studies
+       listed in FHIR_PREFETCH_TAGS. Resolving N keys then costs one paged
+       search per resource type instead of N searches. The index only knows
+       about resources tagged with those studies.
+    4. With FHIR_NEGATIVE_CACHE=true, for identifier keys: keys already
+       searched for in vain during this run, and resource types that had no
+       resources for the key's study tag, or for the study tags loaded so
+       far, when first probed with one _summary=count search per tag.
+       Resources submitted since are known without searching.
+    5. A search on the server, unless skip_target_id_searches was called for
+       the resource type
+
+    :param host: A FHIR service base URL
+    :type host: str
+    :param api_path: A FHIR resource type (e.g. "Patient")
+    :type api_path: str
+    :param key_components: search parameters identifying the entity
+    :type key_components: dict
+    :return: IDs of the matching resources
+    :rtype: list
+    """
+    key_components = drop_none(key_components)
+    tag = key_components.get("_tag")
+
+    if FHIR_ID_STRATEGY == "deterministic":
+        return [deterministic_id(api_path, key_components)]
+
+    if _offline:
+        return []
+
+    if id_cache is not None:
+        cached = id_cache.get(host, api_path, key_components)
+        if cached:
+            return [cached]
+
+    warmed = _warmed.get((host, api_path, canonical_key(key_components)))
+    if warmed is not None:
+        return [resource_id for resource_id, _ in warmed]
+
+    if _prefetched(key_components):
+        found = identifier_index.lookup(
+            host,
+            api_path,
+            key_components["identifier"],
+            {tag} if tag else FHIR_PREFETCH_TAGS,
+        )
+    elif not _searched(api_path):
+        found = []
+    else:
+        remembers_misses = miss_cache is not None and _is_identifier_key(key_components)
+        if remembers_misses:
+            known = miss_cache.lookup(host, api_path, key_components)
+            if known is not None:
+                return [resource_id for resource_id, _ in known]
+
+        found = [
+            (entry["resource"]["id"], study_tag(entry["resource"]))
+            for entry in yield_resources(
+                host,
+                api_path,
+                escape_filters(key_components),
+                count=FHIR_SEARCH_PAGE_SIZE,
+                elements=["identifier"],
+            )
+        ]
+        if remembers_misses and not found:
+            miss_cache.missed(host, api_path, key_components)
+
+    if id_cache is not None and len(found) == 1:
+        resource_id, found_tag = found[0]
+        id_cache.put(host, api_path, key_components, resource_id, tag=found_tag)
+
+    return [resource_id for resource_id, _ in found]
+
+
+def remember_target_id(host, api_path, body, resource_id):
+    """Records the ID that the server gave a submitted resource, so later
+    lookups of its key don't have to search for it.
+    """
+    if not resource_id:
+        return
+
+    if _warmed:
+        tag = study_tag(body)
+        for identifier in body.get("identifier", []):
+            value = identifier.get("value")
+            for key_components in [
+                {"identifier": value},
+                {"identifier": value, "_tag": tag},
+            ]:
+                key = (host, api_path, canonical_key(key_components))
+                if key in _warmed:
+                    _warmed[key] = [(resource_id, tag)]
+
+    if miss_cache is not None:
+        miss_cache.remember(host, api_path, body, resource_id)
+
+    if id_cache is not None:
+        id_cache.remember_resource(host, api_path, body, resource_id)
+
+
+def forget_target_id(host, api_path, resource_id):
+    """Forgets a resource ID that turned out not to exist on the server (e.g.
+    a cached ID from before a server reset), so its keys are looked up again.
+    """
+    for key, found in list(_warmed.items()):
+        if key[:2] == (host, api_path) and any(r == resource_id for r, _ in found):
+            _warmed[key] = [(r, t) for r, t in found if r != resource_id]
+
+    if id_cache is not None:
+        id_cache.forget_id(host, api_path, resource_id)
@@ -0,0 +1,190 @@
+"""
+Parses FHIR search Bundles incrementally from a response stream, so that
+search results are handled entry by entry as they arrive, and keeps track of
+seen resource IDs in a compact hash table.
+"""
+import codecs
+import hashlib
+import json
+import re
+from array import array
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"[ \t\n\r]*")
+
+
+class BundleStream:
+    """Iterates over the entries of a JSON Bundle read from chunks of bytes,
+    decoding one entry at a time. Only the entry being decoded and the
+    unread part of the current chunk are held in memory.
+
+    The Bundle's other top-level fields (total, link, ...) are collected in
+    fields. Fields that come after the entries are only there once every
+    entry has been read.
+    """
+
+    def __init__(self, chunks):
+        """
+        :param chunks: The Bundle's bytes, e.g. Response.iter_content()
+        :type chunks: iterable of bytes
+        """
+        self.fields = {}
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._entries = self._parse()
+
+    def __iter__(self):
+        return self._entries
+
+    def _fill(self, at_least=1):
+        """Appends at least at_least more characters from the stream to the
+        buffer, dropping the part already parsed.
+
+        :return: False if the stream had already ended
+        :rtype: bool
+        """
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos :]
+        self._pos = 0
+        target = len(self._buf) + at_least
+        while len(self._buf) < target:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._buf += self._text.decode(b"", final=True)
+                self._eof = True
+                break
+            self._buf += self._text.decode(chunk)
+        return True
+
+    def _next_char(self):
+        """Skips whitespace and returns the next character."""
+        while True:
+            self._pos = _whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Bundle ended unexpectedly")
+
+    def _expect(self, char):
+        if self._next_char() != char:
+            raise ValueError(
+                f"Expected {char!r} at {self._buf[self._pos:self._pos + 20]!r}"
+            )
+        self._pos += 1
+
+    def _value(self):
+        """Decodes the JSON value at the current position, reading more of
+        the stream until the value is complete.
+        """
+        self._next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+                # A number at the end of the buffer may continue in the
+                # next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Grow the buffer geometrically, so a large value is decoded a
+            # logarithmic number of times
+            if not self._fill(at_least=max(len(self._buf) - self._pos, 1)):
+                raise ValueError("Bundle ended unexpectedly")
+
+    def _parse(self):
+        self._expect("{")
+        while True:
+            char = self._next_char()
+            if char == "}":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            key = self._value()
+            self._expect(":")
+            if key == "entry":
+                yield from self._parse_entries()
+            else:
+                self.fields[key] = self._value()
+
+    def _parse_entries(self):
+        self._expect("[")
+        while True:
+            char = self._next_char()
+            if char == "]":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            yield self._value()
+
+
+class CompactIdSet:
+    """A set of strings kept as 64-bit hashes in an open-addressing table
+    (array of unsigned 64-bit ints), using 8-16 bytes per member instead of
+    the ~100 of a set of str.
+
+    Two different strings collide with probability 2**-64, so for n members a
+    false "already seen" answer has a chance of about n**2 / 2**65 (under
+    1e-7 for a million IDs).
+    """
+
+    def __init__(self, capacity=1024):
+        size = 1
+        while size < capacity * 2:
+            size *= 2
+        self._table = array("Q", bytes(8 * size))
+        self._mask = size - 1
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @staticmethod
+    def _hash(value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    def _slot(self, h):
+        table = self._table
+        mask = self._mask
+        i = h & mask
+        while table[i] and table[i] != h:
+            i = (i + 1) & mask
+        return i
+
+    def __contains__(self, value):
+        return self._table[self._slot(self._hash(value))] != 0
+
+    def add(self, value):
+        """Adds a string.
+
+        :return: True if it wasn't in the set yet
+        :rtype: bool
+        """
+        h = self._hash(value)
+        i = self._slot(h)
+        if self._table[i]:
+            return False
+        self._table[i] = h
+        self._len += 1
+        if self._len * 2 > len(self._table):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._table
+        self._table = array("Q", bytes(16 * len(old)))
+        self._mask = len(self._table) - 1
+        for h in old:
+            if h:
+                self._table[self._slot(h)] = h
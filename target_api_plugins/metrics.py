@@ -0,0 +1,380 @@
+"""
+Collects per-request metrics for the load stage: latency histograms per API
+path and HTTP method, status counts, retries, bytes sent and received, and
+resources submitted per second for each entity class.
+
+When FHIR_METRICS_DIR is set, the metrics are written there, every
+FHIR_METRICS_INTERVAL seconds and when the process exits, as a Prometheus
+textfile (fhir_ingest.prom, for node_exporter's textfile collector) and a
+JSON run summary (fhir_ingest_summary.json).
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+FHIR_METRICS_DIR = os.getenv("FHIR_METRICS_DIR")
+FHIR_METRICS_INTERVAL = float(os.getenv("FHIR_METRICS_INTERVAL", 30))
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def api_path_of(url):
+    """Reduces a request URL to the resource type it addresses, e.g.
+    "/Patient" for ".../Patient/123/_history/1", or "/" for the base URL
+    that Bundles are posted to.
+    """
+    segments = [s for s in urlsplit(url).path.split("/") if s]
+    for segment in segments:
+        if segment[:1].isupper() or segment.startswith("$"):
+            return f"/{segment}"
+    return "/"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, Prometheus style."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """
+        :return: (upper bound, observations <= bound) pairs, ending with +Inf
+        :rtype: list
+        """
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, seen = 0.0, 0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                upper = min(bound, self.max)
+                in_bucket = total - seen
+                fraction = (rank - seen) / in_bucket if in_bucket else 1
+                return lower + (max(upper, lower) - lower) * fraction
+            lower, seen = bound, total
+        return self.max
+
+
+class Metrics:
+    """Thread-safe store of the load stage's metrics."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.latency = {}
+        self.statuses = {}
+        self.retries = {}
+        self.bytes_sent = {}
+        self.bytes_received = {}
+        self.submitted = {}
+        self.failed = {}
+        self.first_submit = {}
+        self.last_submit = {}
+        # Extra summary sections, name -> function returning a JSON-able value
+        self.sections = {}
+        self._lock = threading.Lock()
+
+    def record_request(
+        self,
+        method,
+        url,
+        latency,
+        status=None,
+        retries=0,
+        bytes_sent=0,
+        bytes_received=0,
+    ):
+        """Records one request, including any retries made while sending it.
+
+        :param method: HTTP method
+        :type method: str
+        :param url: Request URL
+        :type url: str
+        :param latency: Seconds from sending to receiving the final response
+        :type latency: float
+        :param status: Final HTTP status, or None if no response came back
+        :type status: int
+        :param retries: Number of times the request was retried
+        :type retries: int
+        """
+        key = (api_path_of(url), method.upper())
+        status_key = key + (str(status) if status is not None else "error",)
+        with self._lock:
+            if key not in self.latency:
+                self.latency[key] = Histogram()
+            self.latency[key].observe(latency)
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+            self.retries[key] = self.retries.get(key, 0) + retries
+            self.bytes_sent[key] = self.bytes_sent.get(key, 0) + bytes_sent
+            self.bytes_received[key] = self.bytes_received.get(key, 0) + bytes_received
+
+    def record_response(self, resp, latency, retries=0, stream=False):
+        """Records a requests.Response, counting the retries made by the
+        session's urllib3 retry policy on top of any passed in.
+
+        :param stream: Whether the response body is streamed, in which case
+            it isn't read here and only its Content-Length is counted
+        :type stream: bool
+        """
+        history = getattr(getattr(resp.raw, "retries", None), "history", None)
+        content_length = resp.headers.get("Content-Length")
+        if content_length is not None:
+            received = int(content_length)
+        else:
+            received = 0 if stream else len(resp.content)
+        self.record_request(
+            resp.request.method,
+            resp.request.url,
+            latency,
+            status=resp.status_code,
+            retries=retries + len(history or ()),
+            bytes_sent=_body_size(resp.request.body),
+            bytes_received=received,
+        )
+
+    def record_submit(self, entity_class, ok=True):
+        """Records one resource submitted for an entity class."""
+        name = entity_class.class_name
+        now = time.time()
+        with self._lock:
+            counts = self.submitted if ok else self.failed
+            counts[name] = counts.get(name, 0) + 1
+            self.first_submit.setdefault(name, now)
+            self.last_submit[name] = now
+
+    def resources_per_second(self, name):
+        elapsed = self.last_submit[name] - self.first_submit[name]
+        submitted = self.submitted.get(name, 0)
+        return submitted / elapsed if elapsed > 0 else float(submitted)
+
+    def summary(self):
+        """
+        :return: JSON-able summary of the run so far
+        :rtype: dict
+        """
+        with self._lock:
+            requests = {}
+            for (api_path, method), hist in sorted(self.latency.items()):
+                statuses = {
+                    status: count
+                    for (path, meth, status), count in sorted(self.statuses.items())
+                    if (path, meth) == (api_path, method)
+                }
+                requests.setdefault(api_path, {})[method] = {
+                    "count": hist.count,
+                    "statuses": statuses,
+                    "retries": self.retries[(api_path, method)],
+                    "bytes_sent": self.bytes_sent[(api_path, method)],
+                    "bytes_received": self.bytes_received[(api_path, method)],
+                    "latency_seconds": {
+                        "mean": hist.sum / hist.count,
+                        "p50": hist.quantile(0.5),
+                        "p95": hist.quantile(0.95),
+                        "p99": hist.quantile(0.99),
+                        "max": hist.max,
+                    },
+                }
+            entity_classes = {
+                name: {
+                    "submitted": self.submitted.get(name, 0),
+                    "failed": self.failed.get(name, 0),
+                    "resources_per_second": self.resources_per_second(name),
+                }
+                for name in sorted(self.first_submit)
+            }
+        summary = {
+            "started": self.started,
+            "elapsed_seconds": time.time() - self.started,
+            "requests": requests,
+            "entity_classes": entity_classes,
+        }
+        for name, section in self.sections.items():
+            summary[name] = section()
+        return summary
+
+    def prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def labels(**kwargs):
+            pairs = ",".join(f'{k}="{_escape_label(v)}"' for k, v in kwargs.items())
+            return "{" + pairs + "}"
+
+        with self._lock:
+            family(
+                "fhir_ingest_request_duration_seconds",
+                "histogram",
+                "Latency of requests to the FHIR service",
+            )
+            for (api_path, method), hist in sorted(self.latency.items()):
+                for bound, total in hist.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(
+                        "fhir_ingest_request_duration_seconds_bucket"
+                        f"{labels(api_path=api_path, method=method, le=le)} {total}"
+                    )
+                lbl = labels(api_path=api_path, method=method)
+                lines.append(
+                    f"fhir_ingest_request_duration_seconds_sum{lbl} {hist.sum}"
+                )
+                lines.append(
+                    f"fhir_ingest_request_duration_seconds_count{lbl} {hist.count}"
+                )
+
+            family(
+                "fhir_ingest_responses_total",
+                "counter",
+                "Responses from the FHIR service by status",
+            )
+            for (api_path, method, status), count in sorted(self.statuses.items()):
+                lines.append(
+                    "fhir_ingest_responses_total"
+                    f"{labels(api_path=api_path, method=method, status=status)} "
+                    f"{count}"
+                )
+
+            for name, values, help_text in [
+                (
+                    "fhir_ingest_request_retries_total",
+                    self.retries,
+                    "Retries of requests to the FHIR service",
+                ),
+                (
+                    "fhir_ingest_request_bytes_sent_total",
+                    self.bytes_sent,
+                    "Request body bytes sent to the FHIR service",
+                ),
+                (
+                    "fhir_ingest_response_bytes_received_total",
+                    self.bytes_received,
+                    "Response body bytes received from the FHIR service",
+                ),
+            ]:
+                family(name, "counter", help_text)
+                for (api_path, method), value in sorted(values.items()):
+                    lines.append(
+                        f"{name}{labels(api_path=api_path, method=method)} {value}"
+                    )
+
+            family(
+                "fhir_ingest_resources_submitted_total",
+                "counter",
+                "Resources submitted per entity class",
+            )
+            for name in sorted(self.first_submit):
+                for outcome, counts in [
+                    ("ok", self.submitted),
+                    ("failed", self.failed),
+                ]:
+                    lines.append(
+                        "fhir_ingest_resources_submitted_total"
+                        f"{labels(entity_class=name, outcome=outcome)} "
+                        f"{counts.get(name, 0)}"
+                    )
+
+            family(
+                "fhir_ingest_resources_per_second",
+                "gauge",
+                "Resources submitted per second per entity class",
+            )
+            for name in sorted(self.first_submit):
+                lines.append(
+                    "fhir_ingest_resources_per_second"
+                    f"{labels(entity_class=name)} {self.resources_per_second(name)}"
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        """Writes fhir_ingest.prom and fhir_ingest_summary.json to directory.
+        Each file is replaced atomically, so collectors never see a partial
+        file.
+        """
+        directory = os.path.expanduser(directory)
+        os.makedirs(directory, exist_ok=True)
+        for filename, content in [
+            ("fhir_ingest.prom", self.prometheus()),
+            (
+                "fhir_ingest_summary.json",
+                json.dumps(self.summary(), indent=2, default=str),
+            ),
+        ]:
+            path = os.path.join(directory, filename)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+    def export_periodically(self, directory, interval):
+        """Writes the metrics every interval seconds from a daemon thread,
+        and once more when the process exits.
+        """
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(directory)
+                except OSError as e:
+                    logger.warning(f"Could not write metrics to {directory}: {e}")
+
+        if interval > 0:
+            threading.Thread(target=run, name="fhir-metrics", daemon=True).start()
+        atexit.register(self.write, directory)
+
+
+metrics = Metrics()
+if FHIR_METRICS_DIR:
+    metrics.export_periodically(FHIR_METRICS_DIR, FHIR_METRICS_INTERVAL)
@@ -0,0 +1,71 @@
+"""
+Writes built FHIR resources to gzipped NDJSON files, one per resource type,
+for server-side bulk import ($import) or archiving instead of REST writes.
+"""
+import atexit
+import gzip
+import json
+import os
+import threading
+import uuid
+
+
+class NdjsonExporter:
+    """Writes resources to <directory>/<resourceType>.ndjson.gz. Each file is
+    started over the first time a run writes to it, so that running the
+    export again replaces the earlier export instead of duplicating it.
+    """
+
+    def __init__(self, directory, compresslevel=6):
+        """
+        :param directory: Directory to write the files to, created if missing
+        :type directory: str
+        :param compresslevel: gzip compression level, 1 (fastest) to 9
+        :type compresslevel: int
+        """
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.compresslevel = compresslevel
+        self._files = {}
+        self._started = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def path(self, resource_type):
+        return os.path.join(self.directory, f"{resource_type}.ndjson.gz")
+
+    def _file(self, resource_type):
+        with self._lock:
+            if resource_type not in self._files:
+                mode = "at" if resource_type in self._started else "wt"
+                self._files[resource_type] = gzip.open(
+                    self.path(resource_type), mode, compresslevel=self.compresslevel
+                )
+                self._started.add(resource_type)
+                self._locks.setdefault(resource_type, threading.Lock())
+            return self._files[resource_type], self._locks[resource_type]
+
+    def write(self, body):
+        """Writes a resource as one NDJSON line. A resource without an ID gets
+        a newly minted UUID, so that other resources can reference it.
+
+        :param body: FHIR resource
+        :type body: dict
+        :return: the resource's ID
+        :rtype: str
+        """
+        if not body.get("id"):
+            body = dict(body, id=str(uuid.uuid4()))
+        line = json.dumps(body, separators=(",", ":"))
+        f, lock = self._file(body["resourceType"])
+        with lock:
+            f.write(line + "\n")
+        return body["id"]
+
+    def close(self):
+        """Flushes and closes every open file."""
+        with self._lock:
+            files, self._files = self._files, {}
+        for f in files.values():
+            f.close()
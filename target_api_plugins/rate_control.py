@@ -0,0 +1,153 @@
+"""
+Adapts the number of concurrent requests sent to the FHIR service to what
+the service can sustain, using its latency and 429/503 answers as feedback.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+# Statuses the FHIR service sends when it is overloaded
+THROTTLE_STATUSES = {429, 503}
+
+# Statuses retried with backoff: throttling and transient server errors. A
+# POST is only retried on THROTTLE_STATUSES with a Retry-After header, since
+# after any other failure the server may already have created the resource.
+RETRY_STATUSES = THROTTLE_STATUSES | {500, 502, 504}
+
+# Longest Retry-After pause that is honored, in seconds
+MAX_RETRY_AFTER = 300
+
+# Longest backoff between retries when the server doesn't say, in seconds
+MAX_BACKOFF = 30
+
+
+def parse_retry_after(value):
+    """Turns a Retry-After header (seconds or an HTTP date) into seconds.
+
+    :return: seconds to wait, or None if the header is missing or invalid
+    :rtype: float
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+def backoff_delay(attempt, backoff_factor):
+    """Seconds to wait before retry number attempt + 1 when the server gave
+    no Retry-After: exponential backoff with full jitter, so that throttled
+    clients don't all come back at once.
+    """
+    return random.uniform(0, min(MAX_BACKOFF, backoff_factor * 2**attempt))
+
+
+class AdaptiveLimiter:
+    """Limits in-flight requests with additive-increase/multiplicative-decrease.
+
+    The limit grows by about one slot per round of successful requests, as
+    long as latency stays within latency_tolerance times the fastest latency
+    seen. It stops growing when latency degrades, and is cut by
+    decrease_factor when the server throttles (429/503) or a request times
+    out. At most one cut happens per round trip, so a burst of throttled
+    requests counts as a single congestion event. A Retry-After header pauses
+    new requests until it has passed.
+    """
+
+    def __init__(
+        self,
+        initial=8,
+        minimum=1,
+        maximum=256,
+        decrease_factor=0.5,
+        latency_tolerance=2.0,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.min_latency = None
+        self.avg_latency = None
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self, latency, throttled=False, retry_after=None):
+        """Frees a slot and adjusts the limit from the request's outcome.
+
+        :param latency: Seconds the request took
+        :type latency: float
+        :param throttled: Whether the server throttled the request or it
+            timed out
+        :type throttled: bool
+        :param retry_after: Seconds the server asked clients to wait
+        :type retry_after: float
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                if now - self._last_decrease > (self.avg_latency or 0):
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            else:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                self.avg_latency = (
+                    latency
+                    if self.avg_latency is None
+                    else 0.9 * self.avg_latency + 0.1 * latency
+                )
+                if self.avg_latency <= self.min_latency * self.latency_tolerance:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Holds a slot for the duration of one request. Call the yielded
+        outcome's throttled() if the server throttled the request.
+        """
+        self.acquire()
+        outcome = _Outcome()
+        start = time.monotonic()
+        try:
+            yield outcome
+        finally:
+            self.release(
+                time.monotonic() - start,
+                throttled=outcome.is_throttled,
+                retry_after=outcome.retry_after,
+            )
+
+
+class _Outcome:
+    def __init__(self):
+        self.is_throttled = False
+        self.retry_after = None
+
+    def throttled(self, retry_after=None):
+        self.is_throttled = True
+        self.retry_after = retry_after
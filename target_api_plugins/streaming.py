@@ -0,0 +1,81 @@
+"""
+Lets transform_records_list take an iterator of records and return one, so
+that a large extract is transformed a chunk at a time instead of being held
+in memory all at once (as the list of records, the DataFrame made from it,
+and the records made from that).
+
+A list keeps the usual behavior. An iterator is read FHIR_TRANSFORM_CHUNK_SIZE
+records at a time, each chunk going through its own DataFrame, so column
+types are inferred per chunk. E.g. a numeric column with gaps only in some
+chunks comes out as int in the others, where the whole-list path would
+make it float throughout.
+
+The ingest loader hands transform_records_list a list. To stream, call it
+with an iterator yourself, e.g. read_records("extract.tsv", sep="\t").
+"""
+import os
+from collections.abc import Iterator
+from itertools import islice
+
+import pandas as pd
+
+# Records per DataFrame when transforming a stream of records
+FHIR_TRANSFORM_CHUNK_SIZE = int(os.getenv("FHIR_TRANSFORM_CHUNK_SIZE", 10000))
+
+
+def is_stream(records_list):
+    """Whether transform_records_list was given an iterator, to be
+    transformed chunk by chunk into another iterator.
+    """
+    return isinstance(records_list, Iterator)
+
+
+def read_records(path, chunk_size=None, **kwargs):
+    """Yields the rows of a CSV file (or TSV, with sep="\t") as records,
+    reading chunk_size rows at a time. Every record has every column of the
+    file, with NaN for empty cells, as in a list of records from a DataFrame.
+
+    :param path: The file to read
+    :type path: str
+    :param kwargs: Passed on to pandas.read_csv
+    """
+    chunk_size = chunk_size or FHIR_TRANSFORM_CHUNK_SIZE
+    with pd.read_csv(path, chunksize=chunk_size, **kwargs) as chunks:
+        for df in chunks:
+            yield from df.to_dict("records")
+
+
+def iter_frames(records, chunk_size=None, columns=()):
+    """Yields DataFrames of up to chunk_size records at a time.
+
+    Every DataFrame has the given columns, and every column of the earlier
+    ones, with NaN where its records lack them. A column missing from all
+    records of one chunk thus doesn't go missing from that chunk's records,
+    as long as it was in an earlier chunk or given.
+
+    :param columns: Columns that the caller reads from every DataFrame
+    :type columns: list
+    """
+    chunk_size = chunk_size or FHIR_TRANSFORM_CHUNK_SIZE
+    seen = {}
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        df = pd.DataFrame(chunk)
+        seen.update(dict.fromkeys(df.columns))
+        yield df.reindex(columns=list(seen) + [c for c in columns if c not in seen])
+
+
+def filter_records(records, keep, columns=(), chunk_size=None):
+    """Yields the records for which keep(df) is True, a chunk at a time.
+
+    :param records: The records to filter
+    :type records: iterator of dict
+    :param keep: Returns a boolean Series of the rows of a DataFrame to keep
+    :type keep: function
+    :param columns: Columns that keep reads
+    :type columns: list
+    """
+    for df in iter_frames(records, chunk_size, columns):
+        yield from df[keep(df)].to_dict("records")
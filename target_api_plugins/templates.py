@@ -0,0 +1,77 @@
+"""
+Compiles the static skeleton of a FHIR resource into a template, so that
+building a resource only fills in its per-record values.
+
+A skeleton is a structure of dicts and lists with Slot markers where the
+per-record values go. Every part of it without a slot is built once, when
+the template is compiled, and shared by all resources rendered from the
+template. Rendering allocates only the dicts and lists on the way to a slot.
+
+Shared parts must not be modified, so don't mutate a rendered resource's
+slot-free parts in place.
+"""
+import keyword
+
+
+class Slot:
+    """Marks where a per-record value goes in a template skeleton."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        if not name.isidentifier() or keyword.iskeyword(name):
+            raise ValueError(f"Slot name must be a Python identifier, not {name!r}")
+        self.name = name
+
+    def __repr__(self):
+        return f"Slot({self.name!r})"
+
+
+def _has_slot(node):
+    if isinstance(node, Slot):
+        return True
+    if isinstance(node, dict):
+        return any(_has_slot(v) for v in node.values())
+    if isinstance(node, list):
+        return any(_has_slot(v) for v in node)
+    return False
+
+
+class Template:
+    """A resource skeleton compiled into a function of its slots.
+
+    Build a resource with template.render(slot_name=value, ...). A missing
+    slot value raises TypeError.
+    """
+
+    def __init__(self, skeleton):
+        """
+        :param skeleton: The resource, with Slot markers for per-record values
+        :type skeleton: dict
+        """
+        self.skeleton = skeleton
+        self.slots = []
+        self._constants = {}
+        source = self._source(skeleton)
+        params = f"*, {', '.join(self.slots)}" if self.slots else ""
+        namespace = dict(self._constants)
+        exec(f"def render({params}):\n    return {source}\n", namespace)
+        self.render = namespace["render"]
+
+    def _source(self, node):
+        """Generates the Python expression that builds a skeleton node."""
+        if isinstance(node, Slot):
+            if node.name not in self.slots:
+                self.slots.append(node.name)
+            return node.name
+        if not _has_slot(node):
+            if node is None or isinstance(node, (str, bool, int)):
+                return repr(node)
+            name = f"_static_{len(self._constants)}"
+            self._constants[name] = node
+            return name
+        if isinstance(node, dict):
+            items = ", ".join(f"{k!r}: {self._source(v)}" for k, v in node.items())
+            return "{" + items + "}"
+        items = ", ".join(self._source(v) for v in node)
+        return "[" + items + "]"
@@ -1,11 +1,264 @@
 import os
+import socket
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, quote_plus, urlencode, urlsplit
 
 from d3b_utils.requests_retry import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    ConnectionError,
+    ConnectTimeout,
+    RequestException,
+    Timeout,
+)
+from urllib3.connection import HTTPConnection
+
+from target_api_plugins.json_stream import BundleStream, CompactIdSet
+from target_api_plugins.metrics import metrics
+from target_api_plugins.rate_control import (
+    THROTTLE_STATUSES,
+    AdaptiveLimiter,
+    backoff_delay,
+    parse_retry_after,
+)
 
 FHIR_COOKIE = os.getenv("FHIR_COOKIE")
 FHIR_USERNAME = os.getenv("FHIR_USERNAME")
 FHIR_PASSWORD = os.getenv("FHIR_PASSWORD")
 
+# Connection pool settings for the shared session
+FHIR_POOL_CONNECTIONS = int(os.getenv("FHIR_POOL_CONNECTIONS", 10))
+FHIR_POOL_MAXSIZE = int(os.getenv("FHIR_POOL_MAXSIZE", 32))
+FHIR_POOL_BLOCK = os.getenv("FHIR_POOL_BLOCK", "false").lower() == "true"
+FHIR_KEEP_ALIVE = os.getenv("FHIR_KEEP_ALIVE", "true").lower() == "true"
+
+# Adaptive concurrency control, driven by the FHIR service's feedback
+FHIR_ADAPTIVE_CONCURRENCY = (
+    os.getenv("FHIR_ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+)
+FHIR_ADAPTIVE_INITIAL = int(os.getenv("FHIR_ADAPTIVE_INITIAL", 8))
+FHIR_ADAPTIVE_MIN = int(os.getenv("FHIR_ADAPTIVE_MIN", 1))
+FHIR_ADAPTIVE_MAX = int(os.getenv("FHIR_ADAPTIVE_MAX", 256))
+FHIR_ADAPTIVE_MAX_RETRIES = int(os.getenv("FHIR_ADAPTIVE_MAX_RETRIES", 10))
+FHIR_ADAPTIVE_BACKOFF = float(os.getenv("FHIR_ADAPTIVE_BACKOFF", 0.5))
+
+# Seconds to wait for the server to connect or send data (0 waits forever)
+FHIR_REQUEST_TIMEOUT = float(os.getenv("FHIR_REQUEST_TIMEOUT", 60))
+
+# Methods that can be sent again after a dropped connection or a timeout,
+# since repeating them doesn't change the result. A PATCH joins them when it
+# is sent If-Match a version, which the first attempt would have changed.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+# Page size asked for by searches that only need IDs or identifiers
+FHIR_SEARCH_PAGE_SIZE = int(os.getenv("FHIR_SEARCH_PAGE_SIZE", 200))
+
+# Search result pages fetched ahead of the one being consumed
+FHIR_SEARCH_READ_AHEAD = int(os.getenv("FHIR_SEARCH_READ_AHEAD", 1))
+
+# Whether searches decode each page's entries from the response stream
+FHIR_SEARCH_STREAM = os.getenv("FHIR_SEARCH_STREAM", "false").lower() == "true"
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Longest search URL sent, e.g. when ORing many identifier values together
+FHIR_MAX_URL_LENGTH = int(os.getenv("FHIR_MAX_URL_LENGTH", 4096))
+
+# Query parameters that page searches by offset
+OFFSET_PARAMS = {"_offset", "_getpagesoffset"}
+
+# What the server says when a PUT names an ID it has no resource for
+NO_RESOURCE_WITH_ID = "no resource with this ID exists"
+
+_session = None
+_session_lock = threading.Lock()
+_limiters = {}
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose sockets have TCP keep-alive turned on, so idle pooled
+    connections aren't silently dropped by load balancers between requests.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        if FHIR_KEEP_ALIVE:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_session():
+    """Returns the process-wide session shared by all FHIR submits and searches.
+
+    The session keeps the retry policy of d3b_utils.requests_retry.Session but
+    mounts a pooled adapter, so connections (and their TLS handshakes) are
+    reused across requests and threads. Pool sizes are read from the
+    environment:
+
+    - FHIR_POOL_CONNECTIONS: number of per-host pools to keep (default 10)
+    - FHIR_POOL_MAXSIZE: connections kept open per host (default 32)
+    - FHIR_POOL_BLOCK: if "true", never open more than FHIR_POOL_MAXSIZE
+      connections to one host and make callers wait instead (default false)
+    - FHIR_KEEP_ALIVE: if "false", close every connection after one request
+      (default true)
+
+    :return: the shared session
+    :rtype: d3b_utils.requests_retry.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = Session()
+                max_retries = session.get_adapter("https://").max_retries
+                if FHIR_ADAPTIVE_CONCURRENCY:
+                    # Throttling and timeouts are handled by the adaptive
+                    # limiter instead. urllib3 would otherwise retry a 429/503
+                    # that carries Retry-After, and any idempotent request
+                    # that timed out, behind the limiter's back.
+                    max_retries = max_retries.new(
+                        status_forcelist=set(max_retries.status_forcelist or [])
+                        - THROTTLE_STATUSES,
+                        respect_retry_after_header=False,
+                        read=False,
+                    )
+                adapter = PooledAdapter(
+                    pool_connections=FHIR_POOL_CONNECTIONS,
+                    pool_maxsize=FHIR_POOL_MAXSIZE,
+                    pool_block=FHIR_POOL_BLOCK,
+                    max_retries=max_retries,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if not FHIR_KEEP_ALIVE:
+                    session.headers["Connection"] = "close"
+                _session = session
+    return _session
+
+
+def get_limiter(url):
+    """Returns the adaptive concurrency limiter for a URL's host."""
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    with _session_lock:
+        if host not in _limiters:
+            _limiters[host] = AdaptiveLimiter(
+                initial=FHIR_ADAPTIVE_INITIAL,
+                minimum=FHIR_ADAPTIVE_MIN,
+                maximum=FHIR_ADAPTIVE_MAX,
+            )
+        return _limiters[host]
+
+
+def send_request(method, url, **kwargs):
+    """Sends a request on the shared session.
+
+    Requests time out after FHIR_REQUEST_TIMEOUT seconds without a
+    connection or data, unless a timeout is given.
+
+    With FHIR_ADAPTIVE_CONCURRENCY=true, the request waits for a slot under
+    its host's adaptive concurrency limit. A 429/503 answer or a timeout
+    shrinks the limit and is retried up to FHIR_ADAPTIVE_MAX_RETRIES times,
+    after the pause that a Retry-After header asks for or else an exponential
+    backoff with jitter. A dropped connection or a timeout is only retried for
+    idempotent requests (see IDEMPOTENT_METHODS), or if the connection was
+    never made, so that e.g. a POST the server may have applied isn't sent
+    twice.
+
+    :param method: HTTP method
+    :type method: str
+    :param url: Request URL
+    :type url: str
+    :param kwargs: Keyword arguments for requests.Session.request
+    :return: the response
+    :rtype: requests.Response
+    """
+    session = get_session()
+    kwargs.setdefault("timeout", FHIR_REQUEST_TIMEOUT or None)
+    if not FHIR_ADAPTIVE_CONCURRENCY:
+        return _timed_request(session, method, url, **kwargs)
+
+    limiter = get_limiter(url)
+    for attempt in range(FHIR_ADAPTIVE_MAX_RETRIES + 1):
+        last_attempt = attempt == FHIR_ADAPTIVE_MAX_RETRIES
+        retry_after = None
+        with limiter.slot() as outcome:
+            try:
+                resp = _timed_request(
+                    session, method, url, retries=int(attempt > 0), **kwargs
+                )
+            except (ConnectionError, Timeout) as e:
+                outcome.throttled()
+                if last_attempt or not (
+                    _is_idempotent(method, kwargs.get("headers"))
+                    or isinstance(e, ConnectTimeout)
+                ):
+                    raise
+            else:
+                if resp.status_code not in THROTTLE_STATUSES or last_attempt:
+                    return resp
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                outcome.throttled(retry_after)
+        if not retry_after:
+            # The limiter only pauses for a Retry-After, so back off here
+            time.sleep(backoff_delay(attempt, FHIR_ADAPTIVE_BACKOFF))
+
+
+def _is_idempotent(method, headers):
+    method = method.upper()
+    return method in IDEMPOTENT_METHODS or (
+        method == "PATCH" and "If-Match" in (headers or {})
+    )
+
+
+def _timed_request(session, method, url, retries=0, **kwargs):
+    """Sends one request on a session and records it in the load metrics."""
+    start = time.monotonic()
+    try:
+        resp = session.request(method, url, **kwargs)
+    except RequestException:
+        metrics.record_request(method, url, time.monotonic() - start, retries=retries)
+        raise
+    metrics.record_response(
+        resp,
+        time.monotonic() - start,
+        retries=retries,
+        stream=kwargs.get("stream", False),
+    )
+    return resp
+
+
+def session_stats():
+    """Reports connection reuse counters for the shared session.
+
+    :return: map from "scheme://host:port" to the number of connections
+        opened, requests sent, and requests that reused an open connection
+    :rtype: dict
+    """
+    stats = {}
+    if _session is None:
+        return stats
+
+    pools = _session.get_adapter("https://").poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host = f"{key.key_scheme}://{key.key_host}:{key.key_port}"
+        stats[host] = {
+            "connections": pool.num_connections,
+            "requests": pool.num_requests,
+            "reused": max(pool.num_requests - pool.num_connections, 0),
+        }
+    return stats
+
+
+metrics.sections["connections"] = session_stats
+
 
 def not_none(val):
     if val is None:
@@ -17,12 +270,293 @@ def drop_none(body):
     return {k: v for k, v in body.items() if v is not None}
 
 
-def yield_resources(host, endpoint, filters, show_progress=False):
+def escape_search_value(value):
+    """Escapes the characters that FHIR search treats as separators in a
+    search parameter value (https://www.hl7.org/fhir/search.html#escaping)
+    """
+    for char in ["\\", ",", "$", "|"]:
+        value = value.replace(char, f"\\{char}")
+    return value
+
+
+def escape_filters(filters):
+    """Escapes every string value of a dict of search filters with
+    escape_search_value, e.g. an entity's key components.
+    """
+    return {
+        k: escape_search_value(v) if isinstance(v, str) else v
+        for k, v in filters.items()
+    }
+
+
+def identifier_key_components(body):
+    """The identifier key components of a resource built by a builder whose
+    get_key_components returns {"identifier": ...}.
+    """
+    return {"identifier": not_none(body["identifier"][0]["value"])}
+
+
+def resource_id_from_location(location):
+    """Extracts the resource ID from a FHIR Location header or Bundle entry
+    response location (e.g. "Patient/123/_history/1" or
+    "http://localhost:8000/Patient/123")
+    """
+    if not location:
+        return None
+    path = location.split("/_history")[0].rstrip("/")
+    return path.rsplit("/", 1)[-1] if "/" in path else None
+
+
+def response_diagnostics(resp):
+    """Returns the diagnostics of the first issue in an OperationOutcome
+    response body, or "" if the body isn't one (e.g. an HTML error page).
+    """
+    try:
+        outcome = resp.json()
+    except ValueError:
+        return ""
+    if not isinstance(outcome, dict):
+        return ""
+    issues = outcome.get("issue") or [{}]
+    return issues[0].get("diagnostics") or ""
+
+
+def response_resource_id(resp):
+    """Finds the ID of the resource that a create or update response is
+    about. The Location (or Content-Location) header is used when the
+    server sent one, and the response body only otherwise, since the body is
+    empty when the request asked for Prefer: return=minimal.
+
+    :param resp: Response to a PUT or POST of a FHIR resource
+    :type resp: requests.Response
+    :raise: RequestException if the response doesn't say which resource it
+        is about, e.g. a return=minimal answer without a Location header
+    :return: the resource ID
+    :rtype: str
+    """
+    location = resp.headers.get("Location") or resp.headers.get("Content-Location")
+    resource_id = resource_id_from_location(location)
+    if not resource_id:
+        try:
+            resource = resp.json()
+        except ValueError:
+            resource = None
+        if isinstance(resource, dict):
+            resource_id = resource.get("id")
+    if not resource_id:
+        raise RequestException(
+            f"Response from {resp.url} has neither a Location header nor a "
+            f"resource id:\n{resp.text}",
+            response=resp,
+        )
+    return resource_id
+
+
+def response_version(resp):
+    """Finds the versionId of the resource a read, update or patch response
+    is about, from its ETag (e.g. W/"3"), its Location (".../_history/3"),
+    or its body.
+
+    :return: the version, or None if the response doesn't say
+    :rtype: str
+    """
+    etag = resp.headers.get("ETag")
+    if etag:
+        return etag[2:].strip('"') if etag.startswith("W/") else etag.strip('"')
+    location = resp.headers.get("Location") or resp.headers.get("Content-Location")
+    if location and "/_history/" in location:
+        return location.rsplit("/_history/", 1)[1].strip("/")
+    try:
+        return resp.json().get("meta", {}).get("versionId")
+    except ValueError:
+        return None
+
+
+def _get_page(url, filters, headers, auth):
+    resp = send_request("GET", url, params=filters, headers=headers, auth=auth)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def _next_link(bundle, host):
+    for link in bundle.get("link", []):
+        if link["relation"] == "next":
+            return link["url"].replace("http://localhost:8000", host)
+    return None
+
+
+def _offset_links(link_next, bundle):
+    """Lists the URLs of all remaining pages of a search whose next link
+    pages by offset (_offset, or HAPI's _getpagesoffset), so they can be
+    fetched concurrently.
+
+    :return: the page URLs in order, or None if the search isn't paged by
+        offset
+    :rtype: list
+    """
+    parts = urlsplit(link_next)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    names = [name for name, _ in query if name in OFFSET_PARAMS]
+    page_size = len(bundle.get("entry", []))
+    if len(names) != 1 or not page_size or "total" not in bundle:
+        return None
+
+    name = names[0]
+    offset = int(dict(query)[name])
+    links = []
+    for page_offset in range(offset, bundle["total"], page_size):
+        page_query = [(k, page_offset if k == name else v) for k, v in query]
+        links.append(parts._replace(query=urlencode(page_query)).geturl())
+    return links
+
+
+def _yield_pages(url, host, filters, headers, auth, read_ahead=0):
+    """Yields the Bundles of every page of a search, in order.
+
+    With read_ahead, up to that many following pages are fetched in
+    background threads while the caller consumes the current one. Pages that
+    are addressed by offset are all known after the first page and are
+    fetched concurrently; otherwise each page's next link is followed as soon
+    as the page arrives.
+    """
+    bundle = _get_page(url, filters, headers, auth)
+    link_next = _next_link(bundle, host)
+    if not read_ahead or link_next is None:
+        yield bundle
+        while link_next is not None:
+            bundle = _get_page(link_next, filters, headers, auth)
+            link_next = _next_link(bundle, host)
+            yield bundle
+        return
+
+    links = deque(_offset_links(link_next, bundle) or [])
+    by_offset = bool(links)
+    if not by_offset:
+        links.append(link_next)
+
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=read_ahead)
+    try:
+        while True:
+            while links and len(pending) < read_ahead:
+                pending.append(
+                    executor.submit(_get_page, links.popleft(), filters, headers, auth)
+                )
+            yield bundle
+            if not pending:
+                break
+            bundle = pending.popleft().result()
+            if not by_offset:
+                link_next = _next_link(bundle, host)
+                if link_next is not None:
+                    links.append(link_next)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _yield_streamed_pages(url, host, filters, headers, auth):
+    """Yields (entries, fields) for every page of a search, where entries
+    decodes the page's entries from the response stream and fields gets the
+    Bundle's other top-level fields. Each page's response is read to the end
+    before the next page is requested.
+    """
+    link_next = url
+    while link_next is not None:
+        resp = send_request(
+            "GET", link_next, params=filters, headers=headers, auth=auth, stream=True
+        )
+        try:
+            resp.raise_for_status()
+            page = BundleStream(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+            yield page, page.fields
+            # Read past any entries left unconsumed to get the next link
+            for _ in page:
+                pass
+        finally:
+            resp.close()
+        link_next = _next_link(page.fields, host)
+
+
+def _search_credentials():
+    headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
+    auth = None
+
+    if FHIR_COOKIE:
+        headers["Cookie"] = FHIR_COOKIE
+
+    if FHIR_USERNAME and FHIR_PASSWORD:
+        auth = (FHIR_USERNAME, FHIR_PASSWORD)
+
+    return headers, auth
+
+
+def count_resources(host, endpoint, filters):
+    """Counts the resources matching a search without fetching any of them
+    (_summary=count).
+
+    :param host: A FHIR service base URL (e.g. "http://localhost:8000")
+    :type host: str
+    :param endpoint: A FHIR service endpoint (e.g. "Patient")
+    :type endpoint: str
+    :param filters: dict of filters to winnow results from the FHIR service
+    :type filters: dict
+    :raises Exception: If the FHIR service doesn't return status 200
+    :return: the number of matching resources
+    :rtype: int
+    """
+    headers, auth = _search_credentials()
+    url = f"{host.rstrip('/')}/{endpoint.lstrip('/')}"
+    bundle = _get_page(url, search_params(filters, summary="count"), headers, auth)
+    return bundle["total"]
+
+
+def search_params(filters, count=None, elements=None, summary=None):
+    """Adds the result-shaping search parameters to a dict of filters.
+
+    :param count: Page size to ask for (_count)
+    :type count: int
+    :param elements: Resource elements to return (_elements), e.g.
+        ["identifier"]. Servers always include id and meta.
+    :type elements: list or str
+    :param summary: Summary mode to ask for (_summary), e.g. "true"
+    :type summary: str
+    :return: the search parameters
+    :rtype: dict
+    """
+    params = dict(filters)
+    if count:
+        params["_count"] = count
+    if elements:
+        params["_elements"] = (
+            elements if isinstance(elements, str) else ",".join(elements)
+        )
+    if summary:
+        params["_summary"] = summary
+    return params
+
+
+def yield_resources(
+    host,
+    endpoint,
+    filters,
+    show_progress=False,
+    count=None,
+    elements=None,
+    summary=None,
+    read_ahead=FHIR_SEARCH_READ_AHEAD,
+    stream=FHIR_SEARCH_STREAM,
+):
     """Scrapes the dataservice for paginated entities matching the filter params.
     Note: It's almost always going to be safer to use this than requests.get
     with search parameters, because you never know when you'll get back more
     than one page of results for a query.
 
+    Callers that need only part of each resource should ask for it with
+    elements or summary, and for large pages with count, so that fewer bytes
+    and round trips are spent on the search.
+
     :param host: A FHIR service base URL (e.g. "http://localhost:8000")
     :type host: str
     :param endpoint: A FHIR service endpoint (e.g. "Patient")
@@ -30,44 +564,43 @@ def yield_resources(host, endpoint, filters, show_progress=False):
     :param filters: dict of filters to winnow results from the FHIR service
         (e.g. {"name": "Children\'s Hospital of Philadelphia"})
     :type filters: dict
+    :param count: Results per page (_count), or None for the server default
+    :type count: int
+    :param elements: Only return these resource elements (_elements)
+    :type elements: list or str
+    :param summary: Only return a summary of each resource (_summary)
+    :type summary: str
+    :param read_ahead: Number of pages to fetch in the background while the
+        current one is consumed, or 0 to fetch each page on demand
+    :type read_ahead: int
+    :param stream: Decode each page's entries as they arrive instead of
+        loading whole pages, and remember seen IDs as 64-bit hashes. Pages
+        are then fetched one at a time, without read_ahead.
+    :type stream: bool
     :raises Exception: If the FHIR service doesn't return status 200
     :yields: resources matching the filters
     """
     host = host.rstrip("/")
     endpoint = endpoint.lstrip("/")
     url = f"{host}/{endpoint}"
+    filters = search_params(filters, count=count, elements=elements, summary=summary)
 
     expected = 0
-    link_next = url
     found_resource_ids = set()
 
-    headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
-    auth = None
-
-    if FHIR_COOKIE:
-        headers["Cookie"] = FHIR_COOKIE
+    headers, auth = _search_credentials()
 
-    if FHIR_USERNAME and FHIR_PASSWORD:
-        auth = (FHIR_USERNAME, FHIR_PASSWORD)
+    if stream:
+        pages = _yield_streamed_pages(url, host, filters, headers, auth)
+        found_resource_ids = CompactIdSet()
+    else:
+        pages = (
+            (bundle.get("entry", []), bundle)
+            for bundle in _yield_pages(url, host, filters, headers, auth, read_ahead)
+        )
 
-    while link_next is not None:
-        resp = Session().get(link_next, params=filters, headers=headers, auth=auth)
-
-        resp.raise_for_status()
-
-        bundle = resp.json()
-        expected = bundle["total"]
-        link_next = None
-
-        for link in bundle.get("link", []):
-            if link["relation"] == "next":
-                link_next = link["url"]
-                link_next = link_next.replace("http://localhost:8000", host)
-
-        if show_progress and not expected:
-            print("o", end="", flush=True)
-
-        for entry in bundle.get("entry", []):
+    for entries, bundle in pages:
+        for entry in entries:
             resource_id = entry["resource"]["id"]
             if resource_id not in found_resource_ids:
                 found_resource_ids.add(resource_id)
@@ -75,11 +608,124 @@ def yield_resources(host, endpoint, filters, show_progress=False):
                     print(".", end="", flush=True)
                 yield entry
 
+        expected = bundle["total"]
+
+        if show_progress and not expected:
+            print("o", end="", flush=True)
+
     found = len(found_resource_ids)
     assert expected == found, f"Found {found} resources but expected {expected}"
 
 
-def yield_resource_ids(host, endpoint, filters, show_progress=False):
+def yield_resource_ids(
+    host, endpoint, filters, show_progress=False, count=FHIR_SEARCH_PAGE_SIZE
+):
     """Simple wrapper around yield_resources that yields just the FHIR resource IDs"""
-    for entry in yield_resources(host, endpoint, filters, show_progress):
+    for entry in yield_resources(
+        host, endpoint, filters, show_progress, count=count, elements="id"
+    ):
         yield entry["resource"]["id"]
+
+
+def chunk_search_values(url, values, filters, max_url_length=None):
+    """Splits search values into chunks whose comma-separated (OR) search,
+    sent with the given filters, fits in a URL of max_url_length characters.
+
+    :param url: The search URL, without query string
+    :type url: str
+    :param values: Unescaped search values
+    :type values: list
+    :param filters: The other search parameters sent with each chunk
+    :type filters: dict
+    :param max_url_length: Longest URL to send (default FHIR_MAX_URL_LENGTH)
+    :type max_url_length: int
+    :yields: lists of values
+    """
+    max_url_length = max_url_length or FHIR_MAX_URL_LENGTH
+    base_length = len(url) + len(f"?{urlencode(filters)}&identifier=")
+    chunk = []
+    length = base_length
+    for value in values:
+        # Each value after the first is preceded by an encoded comma (%2C)
+        value_length = len(quote_plus(escape_search_value(value))) + 3
+        if chunk and length + value_length > max_url_length:
+            yield chunk
+            chunk = []
+            length = base_length
+        chunk.append(value)
+        length += value_length
+    if chunk:
+        yield chunk
+
+
+def resolve_identifiers(
+    host, endpoint, key_components_list, max_url_length=None, show_progress=False
+):
+    """Resolves many entity keys with few searches. Keys that are an
+    identifier value, plus any other search parameters (e.g. _tag), are
+    grouped by their other parameters and searched for with comma-separated
+    (OR) identifier values, as many per search as fit in a URL. Results are
+    mapped back to each key by identifier value. Keys without an identifier
+    are searched for one at a time.
+
+    :param host: A FHIR service base URL (e.g. "http://localhost:8000")
+    :type host: str
+    :param endpoint: A FHIR service endpoint (e.g. "Patient")
+    :type endpoint: str
+    :param key_components_list: Search parameters identifying each entity
+    :type key_components_list: list of dicts
+    :param max_url_length: Longest URL to send (default FHIR_MAX_URL_LENGTH)
+    :type max_url_length: int
+    :return: (resource ID, resource) pairs matching each key, in key order
+    :rtype: list of lists
+    """
+    url = f"{host.rstrip('/')}/{endpoint.lstrip('/')}"
+    results = [[] for _ in key_components_list]
+    groups = {}
+    for i, key_components in enumerate(key_components_list):
+        key_components = drop_none(key_components)
+        value = key_components.get("identifier")
+        if not isinstance(value, str) or not value:
+            results[i] = [
+                (entry["resource"]["id"], entry["resource"])
+                for entry in yield_resources(
+                    host,
+                    endpoint,
+                    escape_filters(key_components),
+                    show_progress,
+                    count=FHIR_SEARCH_PAGE_SIZE,
+                    elements=["identifier"],
+                )
+            ]
+            continue
+        others = tuple(
+            sorted((k, v) for k, v in key_components.items() if k != "identifier")
+        )
+        groups.setdefault(others, {}).setdefault(value, []).append(i)
+
+    for others, indexes_by_value in groups.items():
+        others = escape_filters(dict(others))
+        filters = search_params(
+            others, count=FHIR_SEARCH_PAGE_SIZE, elements=["identifier"]
+        )
+        for chunk in chunk_search_values(
+            url, list(indexes_by_value), filters, max_url_length
+        ):
+            wanted = set(chunk)
+            for entry in yield_resources(
+                host,
+                endpoint,
+                dict(
+                    others,
+                    identifier=",".join(escape_search_value(v) for v in chunk),
+                ),
+                show_progress,
+                count=FHIR_SEARCH_PAGE_SIZE,
+                elements=["identifier"],
+            ):
+                resource = entry["resource"]
+                values = {i.get("value") for i in resource.get("identifier", [])}
+                for value in values & wanted:
+                    for index in indexes_by_value[value]:
+                        results[index].append((resource["id"], resource))
+    return results